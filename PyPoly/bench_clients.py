@@ -0,0 +1,64 @@
+# Many virtual users of one server in a single process, on one event loop: memory per session and delivered messages
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+
+import pypoly_clientlib
+import rolypoly_pb2
+
+
+async def run(args):
+    pypoly_clientlib.raise_fd_limit(args.users + 64)
+    inbox = asyncio.Queue()
+    tracemalloc.start()
+    start = time.monotonic()
+    clients = []
+    for k in range(args.users):
+        clients.append(await pypoly_clientlib.connect(args.first_uid + k, 'bot%d' % k, args.addr, args.port, inbox))
+    await asyncio.wait_for(asyncio.gather(*(asyncio.shield(c.connected) for c in clients)), args.timeout)
+    per_session = tracemalloc.get_traced_memory()[0] / args.users
+    tracemalloc.stop()
+    print('%d users connected in %.2f s, %.0f bytes/session' % (args.users, time.monotonic() - start, per_session))
+
+    received = 0
+
+    async def consume():
+        nonlocal received
+        while True:
+            _, kind, _ = await inbox.get()
+            if kind == rolypoly_pb2.KIND_MESSAGE:
+                received += 1
+
+    consumer = asyncio.ensure_future(consume())
+    sent = 0
+    interval = 1 / (args.rate * args.users)
+    start = time.monotonic()
+    while time.monotonic() - start < args.duration:
+        sender, receiver = random.sample(clients, 2)
+        sender.send(receiver.session.uid, 'hello')
+        sent += 1
+        await asyncio.sleep(max(0.0, start + sent * interval - time.monotonic()))
+    await asyncio.sleep(1)  # Last messages
+    consumer.cancel()
+    print('%d messages sent, %d delivered, %.0f delivered/s' % (sent, received, received / (args.duration + 1)))
+    for c in clients:
+        c.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('addr')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=0.1, help='messages per second sent by every user')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for all users to be connected')
+    parser.add_argument('--first-uid', type=int, default=1000000)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Parse-plus-dispatch cost per received packet, for v1 (type string) and v2 (Kind enum) packets
+import argparse
+import time
+
+import pypoly_proto
+import pypoly_server
+import rolypoly_pb2
+
+
+def sample_messages():
+    msgs = []
+
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_MESSAGE)
+    msg.message.sender_id = 1
+    msg.message.receiver_id = 2
+    msg.message.text = 'Hello, how are you?'
+    msgs.append(msg)
+
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_PONG)
+    msg.u_id = 1
+    msgs.append(msg)
+
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GET_KNOWN_SERVERS)
+    msg.port = 1231
+    msgs.append(msg)
+
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_HOPS_FROM)
+    msg.hops.s_id = 1
+    msg.hops.hops = 3
+    msg.hops.port = 1231
+    msgs.append(msg)
+
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GET_USER_LIST)
+    msgs.append(msg)
+    return msgs
+
+
+def encode(msgs, version):
+    packets = []
+    for msg in msgs:
+        packet = rolypoly_pb2.GenericMessage()
+        packet.CopyFrom(msg)
+        if version == 1:
+            packet.ClearField('kind')
+        else:
+            packet.ClearField('type')
+        packets.append(packet.SerializeToString())
+    return packets
+
+
+def measure(packets, rounds):
+    client_addr = ('127.0.0.1', 5000)
+    start = time.perf_counter_ns()
+    for _ in range(rounds):
+        for data in packets:
+            pypoly_server.parse_datagram(data, client_addr)
+    return (time.perf_counter_ns() - start) / (rounds * len(packets))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=100000)
+    args = parser.parse_args()
+
+    msgs = sample_messages()
+    for version in (1, 2):
+        packets = encode(msgs, version)
+        measure(packets, args.rounds // 10)   # Warm up
+        print('v%d: %.0f ns/packet, %.1f bytes/packet' % (version, measure(packets, args.rounds),
+                                                          sum(map(len, packets)) / len(packets)))
+        for msg, data in zip(msgs, packets):
+            print('    %-16s %.0f ns' % (pypoly_proto.TYPE_NAMES[msg.kind], measure([data], args.rounds // 5)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+# Starts a network of servers on loopback, attaches synthetic clients, drives a chat workload and reports
+# end-to-end latency, packet rates, gossip bandwidth and convergence times as JSON.
+# Servers run as separate processes, because a server keeps all its state in module globals.
+import argparse
+import json
+import os
+import random
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pypoly_clientlib
+import rolypoly_pb2
+from pypoly_stats import get_stats
+
+
+UDP_MAXLEN = 65535
+CONNECT_RETRY_TIME = 0.5
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pypoly_server.py')
+GOSSIP_KINDS = ['GetKnownServers', 'KnownServers', 'GetKnownUsers', 'KnownUsers', 'NewSystemUserInfo',
+                'DelSystemUserInfo', 'CountHops', 'HopsFrom', 'RouteVector']
+
+
+def make_topology(name, n, degree, rnd):
+    # Returns undirected edges between servers 0 .. n-1, always connected
+    if name == 'line':
+        return {(i, i + 1) for i in range(n - 1)}
+    if name == 'ring':
+        return {(i, (i + 1) % n) for i in range(n)} if n > 2 else make_topology('line', n, degree, rnd)
+    if name == 'tree':
+        return {((i - 1) // 2, i) for i in range(1, n)}
+    edges = {(rnd.randrange(i), i) for i in range(1, n)}     # random: spanning tree plus extra edges
+    while len(edges) < min(n * degree // 2, n * (n - 1) // 2):
+        a, b = sorted(rnd.sample(range(n), 2))
+        edges.add((a, b))
+    return edges
+
+
+class Network:
+    def __init__(self, base_port, server_args, workdir):
+        self.base_port = base_port
+        self.server_args = server_args
+        self.workdir = workdir
+        self.procs = {}
+
+    def port(self, i):
+        return self.base_port + i
+
+    def start(self, i, neighbours):
+        conf = os.path.join(self.workdir, 's%d.conf' % i)
+        with open(conf, 'w') as f:
+            f.writelines('127.0.0.1:%d\n' % self.port(nb) for nb in neighbours)
+        log = open(os.path.join(self.workdir, 's%d.log' % i), 'w')
+        self.procs[i] = subprocess.Popen([sys.executable, SERVER, str(self.port(i)), conf] + self.server_args,
+                                         stdout=log, stderr=subprocess.STDOUT)
+
+    def stop(self, i):
+        p = self.procs.pop(i)
+        p.send_signal(signal.SIGINT)
+        try:
+            p.wait(10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+    def stop_all(self):
+        for i in list(self.procs):
+            self.stop(i)
+
+    def stats(self, i):
+        try:
+            st = get_stats('127.0.0.1', self.port(i), 1)
+        except socket.timeout:
+            return None
+        return {c.name: c.value for c in st.counters}
+
+
+class Clients:
+    # Synthetic clients, all served from one selector: they answer pings and timestamp received messages
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        self.clients = {}   # uid -> (socket, server port, Session)
+        self.connected = set()  # uids the servers have confirmed with Connected
+        self.latencies = []
+        self.received = 0
+
+    def connect(self, uid, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
+        s.bind(('127.0.0.1', 0))
+        self.sel.register(s, selectors.EVENT_READ, uid)
+        session = pypoly_clientlib.Session(uid, 'user%d' % uid)
+        self.clients[uid] = (s, port, session)
+        s.sendto(session.connect_request(), ('127.0.0.1', port))
+
+    def wait_connected(self, uids, timeout):
+        # Resends ConnectRequest until every client is confirmed, returns the seconds it took, None on timeout
+        start = time.monotonic()
+        while True:
+            missing = [uid for uid in uids if uid not in self.connected]
+            if not missing:
+                return time.monotonic() - start
+            if time.monotonic() - start >= timeout:
+                return None
+            for uid in missing:
+                s, port, session = self.clients[uid]
+                s.sendto(session.connect_request(), ('127.0.0.1', port))
+            self.run_for(CONNECT_RETRY_TIME)
+
+    def disconnect(self, uid):
+        self.connected.discard(uid)
+        s, _, _ = self.clients.pop(uid)
+        self.sel.unregister(s)
+        s.close()
+
+    def send(self, sender, receiver):
+        s, port, session = self.clients[sender]
+        data, _ = session.message(receiver, str(time.perf_counter_ns()), time.monotonic())
+        s.sendto(data, ('127.0.0.1', port))
+
+    def poll(self, timeout):
+        for key, _ in self.sel.select(timeout):
+            s, port, session = self.clients[key.data]
+            while True:
+                try:
+                    data = s.recv(UDP_MAXLEN)
+                except BlockingIOError:
+                    break
+                replies, event = session.received(data, time.monotonic())
+                for reply in replies:
+                    s.sendto(reply, ('127.0.0.1', port))
+                if event is not None and event[0] == rolypoly_pb2.KIND_CONNECTED:
+                    self.connected.add(key.data)
+                elif event is not None and event[0] == rolypoly_pb2.KIND_MESSAGE:
+                    self.latencies.append((time.perf_counter_ns() - int(event[1].text)) / 1e6)
+                    self.received += 1
+
+    def run_for(self, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            self.poll(min(0.05, max(0.0, end - time.monotonic())))
+
+
+def wait_until(net, clients, servers, check, timeout):
+    # Seconds until check holds for the stats of every server, None on timeout
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if all(st is not None and check(st) for st in map(net.stats, servers)):
+            return time.monotonic() - start
+        clients.run_for(0.2)
+    return None
+
+
+def converged(seconds, what):
+    # The results are meaningless if the network has not settled, so the run stops instead
+    if seconds is None:
+        raise TimeoutError('%s did not happen within the timeout' % what)
+    return seconds
+
+
+def gossip_totals(net, servers):
+    totals = {'gossip_bytes': 0, 'packets_in': 0}
+    for st in map(net.stats, servers):
+        for name, value in (st or {}).items():
+            if name.startswith('packets_in.'):
+                totals['packets_in'] += value
+            elif name.startswith('bytes_in.') and name[len('bytes_in.'):] in GOSSIP_KINDS:
+                totals['gossip_bytes'] += value
+    return totals
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    n = args.servers
+    edges = make_topology(args.topology, n, args.degree, rnd)
+    if args.churn:
+        edges.add((0, n))   # Server n joins later as a leaf of server 0
+    neighbours = {i: sorted({b for a, b in edges if a == i} | {a for a, b in edges if b == i}) for i in range(n + 1)}
+    servers = list(range(n))
+    result = {'servers': n, 'topology': args.topology, 'edges': len(edges), 'clients': args.clients,
+              'rate': args.rate, 'duration': args.duration, 'server_args': args.server_args}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        net = Network(args.base_port, args.server_args, workdir)
+        clients = Clients()
+        try:
+            for i in servers:
+                net.start(i, neighbours[i])
+            converged(wait_until(net, clients, servers, lambda st: True, args.converge_timeout), 'servers answering')
+            uids = [1000 + k for k in range(args.clients)]
+            for k, uid in enumerate(uids):
+                clients.connect(uid, net.port(k % n))
+            converged(clients.wait_connected(uids, args.converge_timeout), 'clients connecting')
+
+            result['startup_convergence'] = converged(wait_until(
+                net, clients, servers,
+                lambda st: st['known_servers'] == n and st['system_users'] == len(uids), args.converge_timeout),
+                'startup convergence')
+
+            before = gossip_totals(net, servers)
+            start = time.monotonic()
+            sent = 0
+            interval = 1 / (args.rate * len(uids))
+            next_send = start
+            while time.monotonic() - start < args.duration:
+                while next_send <= time.monotonic():
+                    sender, receiver = rnd.sample(uids, 2)
+                    clients.send(sender, receiver)
+                    sent += 1
+                    next_send += interval
+                clients.poll(max(0.0, next_send - time.monotonic()))
+            clients.run_for(args.drain)
+            elapsed = time.monotonic() - start
+            after = gossip_totals(net, servers)
+
+            result.update({
+                'sent': sent,
+                'delivered': clients.received,
+                'latency_p50_ms': percentile(clients.latencies, 0.5),
+                'latency_p99_ms': percentile(clients.latencies, 0.99),
+                'delivered_per_s': clients.received / elapsed,
+                'server_packets_per_s': (after['packets_in'] - before['packets_in']) / elapsed,
+                'gossip_bytes_per_s': (after['gossip_bytes'] - before['gossip_bytes']) / elapsed,
+            })
+
+            if args.churn:
+                joined = 0
+                net.start(n, neighbours[n])
+                converged(wait_until(net, clients, [n], lambda st: True, args.converge_timeout),
+                          'joining server answering')
+                clients.connect(joined, net.port(n))
+                converged(clients.wait_connected([joined], args.converge_timeout), 'joining client connecting')
+                result['join_convergence'] = converged(wait_until(
+                    net, clients, servers,
+                    lambda st: st['known_servers'] == n + 1 and st['system_users'] == len(uids) + 1,
+                    args.converge_timeout), 'join convergence')
+                clients.disconnect(joined)
+                net.stop(n)
+                result['leave_convergence'] = converged(wait_until(
+                    net, clients, servers,
+                    lambda st: st['known_servers'] == n and st['system_users'] == len(uids), args.converge_timeout),
+                    'leave convergence')
+        finally:
+            net.stop_all()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--servers', type=int, default=5)
+    parser.add_argument('--topology', choices=['line', 'ring', 'tree', 'random'], default='line')
+    parser.add_argument('--degree', type=int, default=3, help='average neighbours of a server in a random mesh')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=5, help='messages per second sent by every client')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of the chat workload')
+    parser.add_argument('--drain', type=float, default=1, help='seconds to wait for the last messages')
+    parser.add_argument('--churn', action='store_true',
+                        help='also measure convergence after a server joins and after it leaves')
+    parser.add_argument('--converge-timeout', type=float, default=60)
+    parser.add_argument('--base-port', type=int, default=42000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file for the JSON results, stdout by default')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='options passed to every server, after --')
+    args = parser.parse_args()
+    if args.server_args[:1] == ['--']:
+        args.server_args = args.server_args[1:]
+
+    try:
+        result = run(args)
+    except TimeoutError as e:
+        print('Benchmark failed:', e, file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(result, indent=1, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
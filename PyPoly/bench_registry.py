@@ -0,0 +1,57 @@
+# Memory per user and cost of evicting a server's users, for a plain dict of objects and for UserRegistry
+import argparse
+import time
+import tracemalloc
+
+import pypoly_server
+
+
+class LegacyUserInfo:   # SystemUserInfo as it was before __slots__
+    def __init__(self, uid, name, sid, last_alive):
+        self.uid = uid
+        self.name = name
+        self.sid = sid
+        self.last_alive = last_alive
+
+
+def fill(users, cls, count, servers):
+    for uid in range(count):
+        users[uid] = cls(uid, 'user%d' % uid, uid % servers, 0)
+
+
+def evict_dict(users, sid):
+    for uid in [uid for uid in users if users[uid].sid == sid]:
+        del users[uid]
+
+
+def evict_registry(users, sid):
+    users.remove_server(sid)
+
+
+def measure(make, cls, evict, count, servers):
+    tracemalloc.start()
+    users = make()
+    fill(users, cls, count, servers)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter_ns()
+    evict(users, 0)
+    return size / count, (time.perf_counter_ns() - start) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--servers', type=int, default=100)
+    args = parser.parse_args()
+
+    for label, make, cls, evict in (('dict', dict, LegacyUserInfo, evict_dict),
+                                    ('registry', pypoly_server.UserRegistry, pypoly_server.SystemUserInfo,
+                                     evict_registry)):
+        per_user, evict_ms = measure(make, cls, evict, args.users, args.servers)
+        print('%-8s %.0f bytes/user, %.2f ms to evict one server' % (label, per_user, evict_ms))
+
+
+if __name__ == '__main__':
+    main()
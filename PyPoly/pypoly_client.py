@@ -2,6 +2,7 @@ import time
 import tkinter
 import socket
 
+import pypoly_clientlib
 import rolypoly_pb2
 
 
@@ -9,14 +10,17 @@ def millitime():
     return int(time.time() * 1000)
 
 
-UDP_MAXLEN = 1024
+UDP_MAXLEN = 65535
 
 
 my_id = millitime()
 my_name = 'Anonym' + str(my_id)
 receiver_id = 0
+room = ''           # Group the input goes to, set by :room
 sock = s_addr = s_port = None
-users_list = {}
+session = None      # Protocol state, created by :connect
+timers = {}         # seq -> retransmission timer of Tk
+resolving = None    # Name given to :receiver while the server looks it up
 
 
 window = tkinter.Tk()
@@ -29,13 +33,6 @@ input_field = tkinter.Entry(window, text=input_user)
 input_field.pack(side=tkinter.BOTTOM, fill=tkinter.X)
 
 
-def find_id_by_name(name, d):
-    for k in d:
-        if d[k] == name:
-            return k
-    return None
-
-
 def print_str(string):
     messages.insert(tkinter.INSERT, string + '\n')
 
@@ -50,10 +47,23 @@ def enter_pressed(_):
         global my_name
         my_name = user_input.split(' ')[1]
     elif user_input.startswith(':userslist'):
-        users_list_request()
+        send(session.user_list_request(*[int(arg) for arg in user_input.split(' ')[1:3]]))
     elif user_input.startswith(':receiver'):
-        global receiver_id
-        receiver_id = find_id_by_name(user_input.split(' ')[1], users_list)
+        global receiver_id, resolving, room
+        room = ''
+        name = user_input.split(' ')[1]
+        receiver_id = session.find_id_by_name(name)
+        if receiver_id is None:
+            resolving = name
+            send(session.resolve_request(name))
+    elif user_input.startswith(':join'):
+        send(session.group_request(user_input.split(' ')[1]))
+    elif user_input.startswith(':leave'):
+        send(session.group_request(user_input.split(' ')[1], join=False))
+    elif user_input.startswith(':room'):
+        room = user_input.split(' ')[1]
+    elif user_input.startswith(':find'):
+        send(session.resolve_request(user_input.split(' ')[1], prefix=True))
     else:
         print_str(my_name + '> ' + user_input)
         send_msg(user_input)
@@ -64,69 +74,109 @@ def enter_pressed(_):
 
 def connect(addr, port):
     disconnect()
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'ConnectRequest'
-    msg.connect_request.u_id = my_id
-    msg.connect_request.username = my_name
-
-    global sock, s_addr, s_port
+    global sock, s_addr, s_port, session
+    if session is None:
+        session = pypoly_clientlib.Session(my_id, my_name)
+    session.name = my_name
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     window.createfilehandler(sock, tkinter.READABLE, got_message)
-    sock.sendto(msg.SerializeToString(), (addr, port))
     s_addr = addr
     s_port = port
+    send(session.connect_request())
+
+
+def send(data):
+    sock.sendto(data, (s_addr, s_port))
 
 
 def send_msg(text):
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'Message'
-    msg.message.sender_id = my_id
-    msg.message.receiver_id = receiver_id
-    msg.message.text = text
-    sock.sendto(msg.SerializeToString(), (s_addr, s_port))
+    if room:
+        send(session.group_message(text, group=room))
+        return
+    data, seq = session.message(receiver_id, text, time.monotonic())
+    send(data)
+    if seq is not None:
+        timers[seq] = window.after(int(session.timeout() * 1000), retransmit, seq)
+
+
+def retransmit(seq):
+    del timers[seq]
+    data, given_up = session.retransmit(seq)
+    if data is not None:
+        send(data)
+        timers[seq] = window.after(int(session.timeout() * 1000), retransmit, seq)
+    elif given_up:
+        print_str('# Message not delivered #')
 
 
 def disconnect():
     global sock, s_addr, s_port
+    for timer in timers.values():
+        window.after_cancel(timer)
+    timers.clear()
     if sock is not None:
         window.deletefilehandler(sock)
         sock.close()
         sock = s_addr = s_port = None
 
 
-def users_list_request():
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'GetUserList'
-    sock.sendto(msg.SerializeToString(), (s_addr, s_port))
+def got_message(s, _):
+    data, _ = s.recvfrom(UDP_MAXLEN)
+    replies, event = session.received(data, time.monotonic())
+    for reply in replies:
+        send(reply)
+    if event is not None and event[0] in EVENT_HANDLERS:
+        EVENT_HANDLERS[event[0]](event[1])
 
 
-def set_user_list(ul_proto):
-    global users_list
-    users_list = {}
-    for i in range(len(ul_proto)):
-        users_list[ul_proto[i].s_id] = ul_proto[i].username
+def got_connected():
+    print_str('# Connected succesfully #')
+    send(session.subscribe_request())
 
-    print_str('# List of users: #')
-    for uid in users_list:
-        print_str(str(users_list[uid]))
 
+def got_presence(joined, left, full):
+    if full:
+        return
+    for _, name in joined:
+        print_str('# ' + name + ' joined #')
+    for uid in left:
+        print_str('# ' + str(uid) + ' left #')
 
-def got_message(s, _):
-    data, _ = s.recvfrom(UDP_MAXLEN)
-    msg = rolypoly_pb2.GenericMessage()
-    msg.ParseFromString(data)
-    if msg.type == 'Connected':
-        print_str('# Connected succesfully #')
-    elif msg.type == 'Ping':
-        msg = rolypoly_pb2.GenericMessage()
-        msg.type = 'Pong'
-        msg.u_id = my_id
-        sock.sendto(msg.SerializeToString(), (s_addr, s_port))
-    elif msg.type == 'Message':
-        n = users_list[msg.message.sender_id] if msg.message.sender_id in users_list else str(msg.message.sender_id)
-        print_str(n + '> ' + msg.message.text)
-    elif msg.type == 'UserList':
-        set_user_list(msg.userlist.users)
+
+def got_chat_message(message):
+    n = session.users.get(message.sender_id, str(message.sender_id))
+    print_str(n + '> ' + message.text)
+
+
+def got_group_message(message):
+    n = session.users.get(message.sender_id, str(message.sender_id))
+    print_str('[' + message.group + '] ' + n + '> ' + message.text)
+
+
+def got_user_list():
+    print_str('# List of users: #')
+    for uid in session.users:
+        print_str(str(session.users[uid]))
+
+
+def got_resolved_users(users):
+    global receiver_id, resolving
+    for uid, name in users:
+        print_str(name + ' <id: ' + str(uid) + '>')
+    if resolving is not None:
+        receiver_id = session.find_id_by_name(resolving)
+        print_str('# No user ' + resolving + ' #' if receiver_id is None else '# Receiver set #')
+        resolving = None
+
+
+EVENT_HANDLERS = {
+    rolypoly_pb2.KIND_CONNECTED: lambda value: got_connected(),
+    rolypoly_pb2.KIND_PRESENCE: lambda value: got_presence(*value),
+    rolypoly_pb2.KIND_MESSAGE: got_chat_message,
+    rolypoly_pb2.KIND_GROUP_MESSAGE: got_group_message,
+    rolypoly_pb2.KIND_USER_LIST: lambda value: got_user_list(),
+    rolypoly_pb2.KIND_RESOLVED_USERS: got_resolved_users,
+}
 
 
 frame = tkinter.Frame(window)  # , width=300, height=300)
@@ -0,0 +1,326 @@
+# Client side of the protocol without any user interface.
+# Session keeps the state of one user and does no I/O: requests return datagrams to send, received datagrams return
+# replies to send and an event for the application. Client runs a Session on an asyncio event loop, which many
+# clients may share.
+import asyncio
+import resource
+import socket
+import time
+
+import pypoly_proto
+import rolypoly_pb2
+
+
+UDP_MAXLEN = 65535
+RETRANSMIT_MAX = 8
+UNDELIVERED = -1    # Event kind of a message given up after RETRANSMIT_MAX retransmissions, the value is its seq
+PAGE_REASSEMBLY_TIME = 2    # Pages of a response still incomplete after so long are dropped
+
+
+class Session:
+    __slots__ = 'uid', 'name', 'reliable', 'next_seq', 'unacked', 'rtt', 'dup_filter', 'users', 'list_pages', \
+        'list_started', 'list_range', 'presence_sid', 'presence_version', 'presence_pages', 'presence_started'
+
+    def __init__(self, uid, name):
+        self.uid = uid
+        self.name = name
+        self.reliable = False   # The server acknowledges our messages
+        self.next_seq = 0
+        self.unacked = None     # seq -> [serialized message, time sent, retries], created with the first one
+        self.rtt = None
+        self.dup_filter = None
+        self.users = {}         # uid -> name, of every user this session has heard of
+        self.list_pages = None  # Pages of the UserList being received
+        self.list_started = 0.0  # When its first page came
+        self.list_range = (0, 0)
+        self.presence_sid = 0   # Server and version of system_users the users are in sync with
+        self.presence_version = 0
+        self.presence_pages = None
+        self.presence_started = 0.0
+
+    def connect_request(self):
+        # A session may connect again, to the same or another server: presence resumes, the reliable link starts anew
+        self.reliable = False
+        self.unacked = self.rtt = self.dup_filter = None
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_CONNECT_REQUEST)
+        msg.connect_request.u_id = self.uid
+        msg.connect_request.username = self.name
+        msg.connect_request.reliable = True
+        return msg.SerializeToString()
+
+    def message(self, receiver_id, text, now):
+        # Returns the datagram and its seq, which needs retransmit() after timeout() unless it is None
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_MESSAGE)
+        msg.message.sender_id = self.uid
+        msg.message.receiver_id = receiver_id
+        msg.message.text = text
+        if not self.reliable:
+            return msg.SerializeToString(), None
+        if self.unacked is None:
+            self.unacked = {}
+            self.rtt = pypoly_proto.RttEstimator()
+            self.next_seq = pypoly_proto.first_seq()
+        self.next_seq += 1
+        msg.message.seq = self.next_seq
+        data = msg.SerializeToString()
+        self.unacked[self.next_seq] = [data, now, 0]
+        return data, self.next_seq
+
+    def group_message(self, text, receiver_ids=(), group=''):
+        # Goes to the given receivers and to every member of the group, without acknowledgements
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GROUP_MESSAGE)
+        msg.group_message.sender_id = self.uid
+        msg.group_message.receiver_ids.extend(receiver_ids)
+        msg.group_message.group = group
+        msg.group_message.text = text
+        return msg.SerializeToString()
+
+    def group_request(self, group, join=True):
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_JOIN_GROUP if join else rolypoly_pb2.KIND_LEAVE_GROUP)
+        msg.group_membership.u_id = self.uid
+        msg.group_membership.group = group
+        return msg.SerializeToString()
+
+    def timeout(self):
+        return self.rtt.rto if self.rtt is not None else pypoly_proto.RTO_INITIAL
+
+    def retransmit(self, seq):
+        # Returns the datagram to send again or None, and whether the message was given up
+        entry = self.unacked.get(seq) if self.unacked else None
+        if entry is None:
+            return None, False
+        if entry[2] >= RETRANSMIT_MAX:
+            del self.unacked[seq]
+            return None, True
+        entry[2] += 1
+        self.rtt.backoff()
+        return entry[0], False
+
+    def user_list_request(self, first=0, count=0):
+        self.list_range = (first, count)
+        self.list_pages = None
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GET_USER_LIST)
+        if first or count:
+            msg.page_range.first = first
+            msg.page_range.count = count
+        return msg.SerializeToString()
+
+    def resolve_request(self, name, prefix=False, limit=0):
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_RESOLVE_USER)
+        msg.resolve_user.name = name
+        msg.resolve_user.prefix = prefix
+        msg.resolve_user.limit = limit
+        return msg.SerializeToString()
+
+    def subscribe_request(self):
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_SUBSCRIBE)
+        msg.subscribe.u_id = self.uid
+        msg.subscribe.s_id = self.presence_sid
+        msg.subscribe.since = self.presence_version
+        return msg.SerializeToString()
+
+    def find_id_by_name(self, name):
+        for uid in self.users:
+            if self.users[uid] == name:
+                return uid
+        return None
+
+    def received(self, data, now):
+        # Returns datagrams to send back and an event (kind, value), or None when there is nothing for the application
+        kind, msg = pypoly_proto.parse(data)
+        handler = MESSAGE_HANDLERS.get(kind)
+        if handler is None:
+            return [], None
+        return handler(self, msg, now)
+
+    def got_ping(self):
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_PONG)
+        msg.u_id = self.uid
+        return [msg.SerializeToString()], None
+
+    def got_connected(self, msg):
+        self.reliable = msg.reliable
+        return [], (rolypoly_pb2.KIND_CONNECTED, None)
+
+    def got_ack(self, ack, now):
+        entry = self.unacked.pop(ack.seq, None) if self.unacked else None
+        if entry is not None and entry[2] == 0:     # Karn's algorithm: the RTT of a retransmitted message is ambiguous
+            self.rtt.sample(now - entry[1])
+        return [], None
+
+    def got_message(self, message):
+        replies = []
+        if message.seq:
+            ack = pypoly_proto.new_msg(rolypoly_pb2.KIND_ACK)
+            ack.ack.seq = message.seq
+            replies.append(ack.SerializeToString())
+            if self.dup_filter is None:
+                self.dup_filter = pypoly_proto.DupFilter()
+            if self.dup_filter.duplicate(message.seq):
+                return replies, None
+        return replies, (rolypoly_pb2.KIND_MESSAGE, message)
+
+    def got_user_list_page(self, userlist, now):
+        # The event comes with the last missing page: ([(uid, name)], whether it is the whole list)
+        if not userlist.HasField('page'):
+            return [], (rolypoly_pb2.KIND_USER_LIST, (self.set_users(userlist.users, True), True))
+
+        page = userlist.page
+        if self.list_pages is None or next(iter(self.list_pages.values())).page.seq != page.seq \
+                or now - self.list_started > PAGE_REASSEMBLY_TIME:
+            self.list_pages = {}    # First page, or pages of an older response or of one with pages lost
+            self.list_started = now
+        self.list_pages[page.index] = userlist
+        first, count = self.list_range
+        last = min(first + count, page.count) if count else page.count
+        if not all(i in self.list_pages for i in range(first, last)):
+            return [], None
+        users = [u for i in range(first, last) for u in self.list_pages[i].users]
+        self.list_pages = None
+        replace = first == 0 and last == page.count
+        return [], (rolypoly_pb2.KIND_USER_LIST, (self.set_users(users, replace), replace))
+
+    def got_resolved_users(self, userlist):
+        return [], (rolypoly_pb2.KIND_RESOLVED_USERS, self.set_users(userlist.users, False))
+
+    def got_presence(self, presence, now):
+        # The event comes with the last missing page: ([(uid, name)] joined, [uid] left, whether it is the whole list)
+        if presence.HasField('page'):
+            page = presence.page
+            if self.presence_pages is None or next(iter(self.presence_pages.values())).page.seq != page.seq \
+                    or now - self.presence_started > PAGE_REASSEMBLY_TIME:
+                self.presence_pages = {}
+                self.presence_started = now
+            self.presence_pages[page.index] = presence
+            if len(self.presence_pages) < page.count:
+                return [], None
+            pages = [self.presence_pages[i] for i in range(page.count)]
+            self.presence_pages = None
+        else:
+            pages = [presence]
+
+        if not presence.full and (presence.s_id != self.presence_sid or presence.since != self.presence_version):
+            return [self.subscribe_request()], None     # A push was lost, ask for what is missing
+        joined = self.set_users([u for p in pages for u in p.joined], presence.full)
+        left = [uid for p in pages for uid in p.left]
+        for uid in left:
+            self.users.pop(uid, None)
+        self.presence_sid = presence.s_id
+        self.presence_version = presence.version
+        return [], (rolypoly_pb2.KIND_PRESENCE, (joined, left, presence.full))
+
+    def set_users(self, ul_proto, replace):
+        if replace:
+            self.users = {}
+        found = []
+        for user in ul_proto:
+            self.users[user.s_id] = user.username
+            found.append((user.s_id, user.username))
+        return found
+
+
+MESSAGE_HANDLERS = {
+    rolypoly_pb2.KIND_PING: lambda session, msg, now: session.got_ping(),
+    rolypoly_pb2.KIND_CONNECTED: lambda session, msg, now: session.got_connected(msg),
+    rolypoly_pb2.KIND_ACK: lambda session, msg, now: session.got_ack(msg.ack, now),
+    rolypoly_pb2.KIND_MESSAGE: lambda session, msg, now: session.got_message(msg.message),
+    rolypoly_pb2.KIND_GROUP_MESSAGE:
+        lambda session, msg, now: ([], (rolypoly_pb2.KIND_GROUP_MESSAGE, msg.group_message)),
+    rolypoly_pb2.KIND_USER_LIST: lambda session, msg, now: session.got_user_list_page(msg.userlist, now),
+    rolypoly_pb2.KIND_RESOLVED_USERS: lambda session, msg, now: session.got_resolved_users(msg.userlist),
+    rolypoly_pb2.KIND_PRESENCE: lambda session, msg, now: session.got_presence(msg.presence, now),
+}
+
+
+########################################################################################################################
+class Client(asyncio.DatagramProtocol):
+    # Events are put to the inbox as (client, kind, value), one inbox can be shared by many clients
+    __slots__ = 'session', 'server', 'transport', 'inbox', 'connected'
+
+    def __init__(self, session, server, inbox=None):
+        self.session = session
+        self.server = server
+        self.transport = None
+        self.inbox = inbox if inbox is not None else asyncio.Queue()
+        self.connected = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.sendto(self.session.connect_request(), self.server)
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def datagram_received(self, data, addr):
+        replies, event = self.session.received(data, time.monotonic())
+        for reply in replies:
+            self.transport.sendto(reply, self.server)
+        if event is None:
+            return
+        if event[0] == rolypoly_pb2.KIND_CONNECTED and not self.connected.done():
+            self.connected.set_result(True)
+        self.inbox.put_nowait((self, event[0], event[1]))
+
+    def send(self, receiver_id, text):
+        data, seq = self.session.message(receiver_id, text, time.monotonic())
+        self.transport.sendto(data, self.server)
+        if seq is not None:
+            asyncio.get_running_loop().call_later(self.session.timeout(), self.retransmit, seq)
+        return seq
+
+    def retransmit(self, seq):
+        if self.transport is None:
+            return
+        data, given_up = self.session.retransmit(seq)
+        if data is not None:
+            self.transport.sendto(data, self.server)
+            asyncio.get_running_loop().call_later(self.session.timeout(), self.retransmit, seq)
+        elif given_up:
+            self.inbox.put_nowait((self, UNDELIVERED, seq))
+
+    def send_group(self, text, receiver_ids=(), group=''):
+        self.transport.sendto(self.session.group_message(text, receiver_ids, group), self.server)
+
+    def join_group(self, group):
+        self.transport.sendto(self.session.group_request(group), self.server)
+
+    def leave_group(self, group):
+        self.transport.sendto(self.session.group_request(group, join=False), self.server)
+
+    def request_user_list(self, first=0, count=0):
+        self.transport.sendto(self.session.user_list_request(first, count), self.server)
+
+    def subscribe(self):
+        self.transport.sendto(self.session.subscribe_request(), self.server)
+
+    def resolve(self, name, prefix=False, limit=0):
+        self.transport.sendto(self.session.resolve_request(name, prefix, limit), self.server)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.inbox.get()
+
+
+async def connect(uid, name, addr, port, inbox=None, timeout=None, session=None):
+    # Waits for Connected when a timeout is given, raises asyncio.TimeoutError if it does not come.
+    # The session of an earlier connection can be given to resume its presence subscription.
+    loop = asyncio.get_running_loop()
+    client = Client(session or Session(uid, name), (socket.gethostbyname(addr), port), inbox)
+    await loop.create_datagram_endpoint(lambda: client, local_addr=('0.0.0.0', 0))
+    if timeout is not None:
+        await asyncio.wait_for(asyncio.shield(client.connected), timeout)
+    return client
+
+
+def raise_fd_limit(needed):
+    # Every client has its own socket, as servers tell clients apart by address
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
@@ -0,0 +1,109 @@
+import collections
+import time
+
+import rolypoly_pb2
+
+
+# v1 packets name their kind with a string, v2 packets with the Kind enum
+TYPE_NAMES = {
+    rolypoly_pb2.KIND_EOF: 'EOF',
+    rolypoly_pb2.KIND_GET_KNOWN_SERVERS: 'GetKnownServers',
+    rolypoly_pb2.KIND_KNOWN_SERVERS: 'KnownServers',
+    rolypoly_pb2.KIND_GET_KNOWN_USERS: 'GetKnownUsers',
+    rolypoly_pb2.KIND_KNOWN_USERS: 'KnownUsers',
+    rolypoly_pb2.KIND_CONNECT_REQUEST: 'ConnectRequest',
+    rolypoly_pb2.KIND_CONNECTED: 'Connected',
+    rolypoly_pb2.KIND_PING: 'Ping',
+    rolypoly_pb2.KIND_PONG: 'Pong',
+    rolypoly_pb2.KIND_NEW_SYSTEM_USER_INFO: 'NewSystemUserInfo',
+    rolypoly_pb2.KIND_DEL_SYSTEM_USER_INFO: 'DelSystemUserInfo',
+    rolypoly_pb2.KIND_COUNT_HOPS: 'CountHops',
+    rolypoly_pb2.KIND_HOPS_FROM: 'HopsFrom',
+    rolypoly_pb2.KIND_ROUTE_VECTOR: 'RouteVector',
+    rolypoly_pb2.KIND_MESSAGE: 'Message',
+    rolypoly_pb2.KIND_GET_USER_LIST: 'GetUserList',
+    rolypoly_pb2.KIND_USER_LIST: 'UserList',
+    rolypoly_pb2.KIND_BATCH: 'Batch',
+    rolypoly_pb2.KIND_RESOLVE_USER: 'ResolveUser',
+    rolypoly_pb2.KIND_RESOLVED_USERS: 'ResolvedUsers',
+    rolypoly_pb2.KIND_GET_STATS: 'GetStats',
+    rolypoly_pb2.KIND_STATS: 'Stats',
+    rolypoly_pb2.KIND_ACK: 'Ack',
+    rolypoly_pb2.KIND_SUBSCRIBE: 'Subscribe',
+    rolypoly_pb2.KIND_PRESENCE: 'Presence',
+    rolypoly_pb2.KIND_GROUP_MESSAGE: 'GroupMessage',
+    rolypoly_pb2.KIND_JOIN_GROUP: 'JoinGroup',
+    rolypoly_pb2.KIND_LEAVE_GROUP: 'LeaveGroup',
+}
+KINDS = {name: kind for kind, name in TYPE_NAMES.items()}
+
+RTO_INITIAL = 1.0    # Seconds, before the first RTT sample
+RTO_MIN = 0.2
+RTO_MAX = 10.0
+RTO_GRANULARITY = 0.01
+DUP_WINDOW = 1024    # Sequence numbers remembered per peer
+
+send_v1_type = True     # Also fill the type string, so that v1 peers understand sent packets during an upgrade
+
+
+def new_msg(kind):
+    msg = rolypoly_pb2.GenericMessage()
+    msg.kind = kind
+    if send_v1_type:
+        msg.type = TYPE_NAMES[kind]
+    return msg
+
+
+def kind_of(msg):
+    return msg.kind or KINDS.get(msg.type, rolypoly_pb2.KIND_UNKNOWN)
+
+
+def parse(data):
+    msg = rolypoly_pb2.GenericMessage()
+    msg.ParseFromString(data)
+    return kind_of(msg), msg
+
+
+def first_seq():
+    # Sequence numbers start from the clock, so that a restarted peer does not reuse numbers still remembered
+    return int(time.time() * 1000) << 16
+
+
+class RttEstimator:
+    # Retransmission timeout of one peer, as in RFC 6298
+    __slots__ = 'srtt', 'rttvar', 'rto'
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = RTO_INITIAL
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + max(RTO_GRANULARITY, 4 * self.rttvar), RTO_MIN), RTO_MAX)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, RTO_MAX)
+
+
+class DupFilter:
+    # Sequence numbers recently received from one peer
+    __slots__ = 'seen', 'order'
+
+    def __init__(self):
+        self.seen = set()
+        self.order = collections.deque()
+
+    def duplicate(self, seq):
+        if seq in self.seen:
+            return True
+        self.seen.add(seq)
+        self.order.append(seq)
+        if len(self.order) > DUP_WINDOW:
+            self.seen.discard(self.order.popleft())
+        return False
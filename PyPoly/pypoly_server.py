@@ -3,21 +3,41 @@
 
 
 import argparse
+import asyncio
+import bisect
+import collections
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
 import queue
+import random
+import select
+import selectors
 import signal
 import socket
+import struct
 import sys
 import threading
 import time
 
+from google.protobuf.message import DecodeError
+
+import pypoly_proto
 import rolypoly_pb2
 
 
 class SocketInfo:
+    __slots__ = 'addr', 'port'
+
     def __init__(self, addr, port):
         self.addr = addr
         self.port = port
 
+    def same(self, other):
+        return self.addr == other.addr and self.port == other.port
+
     @staticmethod
     def from_str(init_str):
         addr, port = init_str.split(':')
@@ -26,17 +46,23 @@ class SocketInfo:
 
 
 class ClientInfo:
-    def __init__(self, uid, name, socketinfo, last_alive):
+    __slots__ = 'uid', 'name', 'socketinfo', 'last_alive', 'reliable', 'groups'
+
+    def __init__(self, uid, name, socketinfo, last_alive, reliable=False):
         self.uid = uid
         self.name = name
         self.socketinfo = socketinfo
         self.last_alive = last_alive
+        self.reliable = reliable
+        self.groups = None  # Names of the groups joined, created with the first one
 
     def __repr__(self):
         return self.name + '<id: ' + str(self.uid) + '>'
 
 
 class SystemUserInfo:
+    __slots__ = 'uid', 'name', 'sid', 'last_alive'
+
     def __init__(self, uid, name, sid, last_alive):
         self.uid = uid
         self.name = name
@@ -50,7 +76,144 @@ class SystemUserInfo:
         return self.__str__()
 
 
+class UserRegistry:
+    # Users of the whole system, kept in columns instead of one object per user: the server of every uid, and per
+    # server the names of its users. Records are handed out as new SystemUserInfo objects, whose last_alive is the
+    # latest one that came with any user of the same server, as users are alive exactly as long as their server.
+    # An entry of the name index is a bare uid while it is the only one with its name, a set of uids otherwise.
+    def __init__(self):
+        self.sids = {}      # uid -> sid
+        self.by_sid = {}    # sid -> {uid: name}
+        self.alive = {}     # sid -> last_alive
+        self.by_name = {}
+        self.names = []     # Sorted keys of by_name, for prefix lookups, plus stale names not swept out yet
+        self.stale = set()  # Names in self.names which no longer have users, removed lazily in one sweep
+
+    def __contains__(self, uid):
+        return uid in self.sids
+
+    def __getitem__(self, uid):
+        sid = self.sids[uid]
+        return SystemUserInfo(uid, self.by_sid[sid][uid], sid, self.alive[sid])
+
+    def __setitem__(self, uid, suinfo):
+        if uid in self.sids:
+            del self[uid]
+        self.sids[uid] = suinfo.sid
+        if suinfo.sid not in self.by_sid:
+            self.by_sid[suinfo.sid] = {}
+            self.alive[suinfo.sid] = suinfo.last_alive
+        self.by_sid[suinfo.sid][uid] = suinfo.name
+        self.alive[suinfo.sid] = max(self.alive[suinfo.sid], suinfo.last_alive)
+        if suinfo.name in self.stale:
+            self.stale.discard(suinfo.name)
+        elif suinfo.name not in self.by_name:
+            bisect.insort(self.names, suinfo.name)
+        self._index(self.by_name, suinfo.name, uid)
+
+    def __delitem__(self, uid):
+        sid = self.sids.pop(uid)
+        users = self.by_sid[sid]
+        name = users.pop(uid)
+        if not users:
+            del self.by_sid[sid]
+            del self.alive[sid]
+        self._unname(name, uid)
+
+    def __iter__(self):
+        return iter(self.sids)
+
+    def __len__(self):
+        return len(self.sids)
+
+    def get(self, uid, default=None):
+        return self[uid] if uid in self.sids else default
+
+    def values(self):
+        return [self[uid] for uid in self.sids]
+
+    def servers(self):
+        return self.by_sid.keys()
+
+    def last_alive(self, sid):
+        return self.alive.get(sid)
+
+    def sid_of(self, uid):
+        return self.sids[uid]
+
+    def uids_of(self, sid):
+        return list(self.by_sid.get(sid, ()))
+
+    def users_of(self, sid):
+        users = self.by_sid.get(sid, {})
+        return [SystemUserInfo(uid, users[uid], sid, self.alive[sid]) for uid in users]
+
+    def named(self, name):
+        return [self[uid] for uid in self._lookup(self.by_name, name)]
+
+    def prefixed(self, prefix, limit):
+        found = []
+        for i in range(bisect.bisect_left(self.names, prefix), len(self.names)):
+            if not self.names[i].startswith(prefix) or len(found) >= limit:
+                break
+            found.extend(self.named(self.names[i]))
+        return found[:limit]
+
+    def copy_columns(self):
+        # Cheap copies, which another thread may read while the processor goes on changing the registry
+        return {sid: dict(users) for sid, users in self.by_sid.items()}, dict(self.alive)
+
+    def remove_server(self, sid):
+        removed = self.users_of(sid)
+        self.by_sid.pop(sid, None)  # Dropped whole, not user by user
+        self.alive.pop(sid, None)
+        for suinfo in removed:
+            del self.sids[suinfo.uid]
+            self._unname(suinfo.name, suinfo.uid)
+        return removed
+
+    def _unname(self, name, uid):
+        self._unindex(self.by_name, name, uid)
+        if name not in self.by_name:
+            self._drop_name(name)
+
+    def _drop_name(self, name):
+        self.stale.add(name)
+        if len(self.stale) > len(self.names) // 2:  # Deleting one by one would move the whole list every time
+            self.names = [other for other in self.names if other not in self.stale]
+            self.stale.clear()
+
+    @staticmethod
+    def _index(index, key, uid):
+        uids = index.get(key)
+        if uids is None:
+            index[key] = uid
+        elif isinstance(uids, set):
+            uids.add(uid)
+        else:
+            index[key] = {uids, uid}
+
+    @staticmethod
+    def _unindex(index, key, uid):
+        uids = index[key]
+        if not isinstance(uids, set):
+            del index[key]
+            return
+        uids.discard(uid)
+        if len(uids) == 1:
+            index[key] = uids.pop()
+
+    @staticmethod
+    def _lookup(index, key):
+        if key not in index:
+            return []
+        uids = index[key]
+        return list(uids) if isinstance(uids, set) else [uids]
+
+
 class Event:
+    __slots__ = 'ev_type', 'content'
+
     def __init__(self, ev_type, content=None):
         self.ev_type = ev_type
         self.content = content
@@ -62,27 +225,341 @@ class Event:
         return s
 
 
+class Histogram:
+    # Latencies in power of two buckets of microseconds
+    __slots__ = 'count', 'total', 'buckets'
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, micros):
+        self.count += 1
+        self.total += micros
+        self.buckets[min(micros.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+
+class Timers:
+    # All periodic and one-shot deadlines of the processor, kept in one heap and fired by the processor itself
+    def __init__(self):
+        self.heap = []
+        self.counter = 0    # Tie breaker, so that events are never compared
+        self.pending = 0
+
+    def add(self, delay, event):
+        self.counter += 1
+        entry = [time.monotonic() + delay, self.counter, event]
+        heapq.heappush(self.heap, entry)
+        self.pending += 1
+        return entry
+
+    def cancel(self, entry):
+        if entry[2] is not None:
+            entry[2] = None     # Cancelled entries are dropped lazily when they reach the top of the heap
+            self.pending -= 1
+
+    def next_deadline(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def next_delay(self):
+        deadline = self.next_deadline()
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    def pop_due(self):
+        due = []
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if entry[2] is not None:
+                due.append(entry[2])
+                entry[2] = None     # Fired, so a later cancel() of the entry does nothing
+                self.pending -= 1
+        return due
+
+
+class ExpiryQueue:
+    # Keys ordered by their last alive timestamp. Refreshing a key only updates the timestamp in its table,
+    # outdated heap entries are pushed again with the new timestamp when they come to the top.
+    def __init__(self, max_age, last_alive, jitter=0):
+        self.heap = []
+        self.max_age = max_age * 1000
+        self.last_alive = last_alive    # key -> current timestamp, None when the key is not tracked anymore
+        self.jitter = int(jitter * 1000)    # Keys expire up to so much later, at random, so that they do not go in step
+
+    def push(self, key, last_alive):
+        if self.jitter:
+            last_alive += random.randrange(self.jitter)
+        heapq.heappush(self.heap, (last_alive, key))
+
+    def pop_expired(self, curtime):
+        expired = []
+        found = set()
+        while self.heap and curtime - self.heap[0][0] > self.max_age:
+            stamp, key = heapq.heappop(self.heap)
+            current = self.last_alive(key)
+            if current is None or key in found:     # Gone already, or pushed more than once
+                continue
+            if current > stamp:
+                self.push(key, current)
+            else:
+                expired.append(key)
+                found.add(key)
+        return expired
+
+
+class EventQueue:
+    # Events waiting for the processor, in priority classes served strictly in order. A full class drops its oldest
+    # or the newest event, or blocks the producer until the processor makes room.
+    def __init__(self, caps, policies):
+        self.classes = [collections.deque() for _ in caps]
+        self.caps = list(caps)
+        self.policies = list(policies)
+        self.size = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def put(self, ev):
+        if ev.ev_type == 'BATCH':   # Events of a batch may belong to different classes
+            for e in ev.content:
+                self.put(e)
+            return
+        c = EVENT_CLASSES.get(ev.ev_type, 0)
+        events = self.classes[c]
+        with self.lock:
+            if len(events) >= self.caps[c] and self.policies[c] == 'block':
+                stats['queue_blocked.' + QUEUE_CLASSES[c]] += 1
+                while len(events) >= self.caps[c] and not self.closed:
+                    self.not_full.wait()
+            if self.closed:
+                return
+            if len(events) >= self.caps[c]:
+                stats['shed.' + QUEUE_CLASSES[c]] += 1
+                if self.policies[c] == 'newest':
+                    return
+                events.popleft()
+                self.size -= 1
+            events.append(ev)
+            self.size += 1
+            self.not_empty.notify()
+
+    def get(self, timeout=None):
+        # Returns None once closed and empty, raises queue.Empty after the timeout
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: self.size or self.closed, timeout):
+                raise queue.Empty
+            for c, events in enumerate(self.classes):
+                if events:
+                    self.size -= 1
+                    if self.policies[c] == 'block':
+                        self.not_full.notify_all()
+                    return events.popleft()
+            return None
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def qsize(self):
+        return self.size
+
+    def depths(self):
+        return {name: len(events) for name, events in zip(QUEUE_CLASSES, self.classes)}
+
+
+class ReliableLink:
+    # Messages sent to one neighbour or client in reliable mode, which wait for their Ack
+    __slots__ = 'next_seq', 'unacked', 'waiting', 'rtt', 'backed_off'
+
+    def __init__(self):
+        self.next_seq = pypoly_proto.first_seq()
+        self.unacked = {}   # seq -> [serialized message, to a server, retransmission timer, time last sent, retries]
+        self.waiting = collections.deque()  # (GenericMessage, to a server) which did not fit in the window
+        self.rtt = pypoly_proto.RttEstimator()
+        self.backed_off = 0.0   # When the RTO was last doubled
+
+
+class SeenCache:
+    # Ids of flooded messages already received, forgotten when least recently seen or after ttl seconds.
+    # Datagrams are parsed by the listener, stream and relay threads, so it has its own lock.
+    def __init__(self, capacity, ttl):
+        self.seen = collections.OrderedDict()   # (origin, seq) -> time last seen, oldest first
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def duplicate(self, key):
+        now = time.monotonic()
+        with self.lock:
+            while self.seen and (len(self.seen) >= self.capacity or now - next(iter(self.seen.values())) > self.ttl):
+                self.seen.popitem(last=False)
+            duplicate = key in self.seen
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+            return duplicate
+
+    def __len__(self):
+        return len(self.seen)
+
+
+class StreamLink:
+    # Connection to a neighbour for messages to it. The processor queues frames, the stream thread writes them.
+    __slots__ = 'addr', 'sock', 'connected', 'out', 'queued', 'retry_at'
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.sock = None
+        self.connected = False
+        self.out = collections.deque()  # Length prefixes and messages, written together by one sendmsg
+        self.queued = 0
+        self.retry_at = 0
+
+
 def millitime():
     return int(time.time() * 1000)
 
 
-MSG_RESEND_TIME = 0.5
+HISTOGRAM_BUCKETS = 24    # The last one takes everything from about 4 s up
+
+
+ROUTE_RETRY_TIME = 2
+ROUTE_ADVERT_TIME = 2
+ROUTE_MAX_AGE = 3 * ROUTE_ADVERT_TIME   # Routes not advertised again for so long are dropped
+ROUTE_TRIGGER_DELAY = 0.1               # Changed routes are advertised sooner than the next periodic vector
+ROUTE_INFINITY = 16
+SNAPSHOT_MAX_AGE = 1      # Cached tables may carry last alive times this old (seconds)
+WORKERS_SYNC_TIME = 0.2   # How often changes of the forwarding table are sent to worker processes
 SERV_DISCOVERY_TIME = CLIENT_DISCOVERY_TIME = 5
 CLIENT_MAX_ALIVE_TIME = 10
+CLIENT_IDLE_TIME = 3      # Clients silent for so long are pinged, any datagram from a client renews its lease
+CLIENT_PING_TICK = 0.5    # How often idle clients are looked for
+CLIENT_PING_JITTER = CLIENT_IDLE_TIME / 2   # Up to so much is added at random to the idle time before a ping
 SERV_MAX_ALIVE_TIME = 20
 USERS_DISCOVERY_TIME = 2
 USERS_MAX_ALIVE_TIME = 8
-UDP_MAXLEN = 1024
-
-
-q = queue.Queue()
+UDP_MAXLEN = 1024        # Default size budget of sent datagrams, larger responses are split into pages
+UDP_RECV_MAXLEN = 65535
+PAGE_REASSEMBLY_TIME = 2
+PAGE_MAX_PARTIAL = 64     # Responses being reassembled at once
+BATCH_OVERHEAD = 16       # Bytes of a Batch datagram besides its envelopes
+BATCH_ENVELOPE_OVERHEAD = 4
+PENDING_MAX_MSGS = 256   # Per destination server
+FLOOD_SEEN_MAX = 4096    # Flooded messages remembered to drop their copies coming around cycles
+FLOOD_SEEN_TTL = 30
+MAILBOX_TTL = 10         # Seconds messages to a receiver not known yet are kept
+MAILBOX_MAX_BYTES = 4096  # Per receiver
+MAILBOX_MAX_USERS = 4096
+MAILBOX_MSG_OVERHEAD = 64    # Bytes a stored message takes besides its text
+SEND_WINDOW = 32         # Unacknowledged messages per peer in reliable mode
+SEND_QUEUE_MAX = 256     # Messages per peer waiting for room in the send window
+RETRANSMIT_MAX = 8
+RESOLVE_MAX_RESULTS = 32  # Users returned by one ResolveUser
+USERS_LOG_LEN = 1024     # Changes of system_users remembered for incremental KnownUsers
+STATS_DUMP_TIME = 10
+STATE_SAVE_TIME = 2
+PRESENCE_PUSH_TIME = 0.2  # Changes of system_users are pushed to subscribed clients together, at most this often
+STREAM_BUDGET = 256 * 1024      # Size of pages sent over stream links
+STREAM_MAX_FRAME = 16 * 1024 * 1024
+STREAM_MAX_QUEUED = 4 * 1024 * 1024     # Bytes waiting to be written to one neighbour, more messages are dropped
+STREAM_RETRY_TIME = 1
+STREAM_MAX_IOV = 512    # Buffers written by one sendmsg
+STREAM_HEADER = struct.Struct('!I')
+QUEUE_CLASSES = ('control', 'requests', 'chat')     # Priority classes of queued events, served in this order
+QUEUE_CAPS = (4096, 1024, 8192)
+QUEUE_POLICIES = ('oldest', 'newest', 'oldest')     # What a full class does: drop oldest, drop newest or block
+EVENT_CLASSES = {   # Events not listed are control: liveness, gossip and routing
+    'SEND_USER_LIST': 1,
+    'RESOLVE_USER': 1,
+    'SUBSCRIBE': 1,
+    'JOIN_GROUP': 1,
+    'LEAVE_GROUP': 1,
+    'SEND_STATS': 1,
+    'SEND_MESSAGE': 2,
+    'RELIABLE_MESSAGE': 2,
+    'GROUP_MESSAGE': 2,
+}
+
+
+q = EventQueue(QUEUE_CAPS, QUEUE_POLICIES)
+loop = None     # Event loop of the asyncio engine, None when running with threads
+loop_timer = None
+timers = Timers()
 nbs = []
 my_id = millitime()     # Own ID is time (in milliseconds) when the server started
 known_servers = {my_id: millitime()}
 my_port = 0
 my_clients = {}
-system_users = {}
-rout_table = {}
+system_users = UserRegistry()
+servers_expiry = ExpiryQueue(SERV_MAX_ALIVE_TIME, lambda sid: known_servers.get(sid) if sid != my_id else None)
+clients_expiry = ExpiryQueue(CLIENT_MAX_ALIVE_TIME,
+                             lambda cid: my_clients[cid].last_alive if cid in my_clients else None)
+clients_idle = ExpiryQueue(CLIENT_IDLE_TIME, lambda cid: my_clients[cid].last_alive if cid in my_clients else None,
+                           CLIENT_PING_JITTER)
+clients_by_addr = {}    # (addr, port) -> uid of a local client
+users_expiry = ExpiryQueue(USERS_MAX_ALIVE_TIME,     # By server: remote users expire all at once with their server
+                           lambda sid: max(known_servers.get(sid, 0), system_users.last_alive(sid))
+                           if sid != my_id and sid in system_users.servers() else None)
+rout_table = {}     # sid -> (hops, next hop, time of the last refresh), or None while the route is looked for
+routes_changed = False
+pending_msgs = {}   # Messages waiting for a route, per destination server id
+pending_cap = PENDING_MAX_MSGS
+pending_drop = 'oldest'
+mailboxes = {}      # uid of a receiver not known yet -> [(deadline, sender id, text), bytes, expiry timer]
+mailbox_ttl = MAILBOX_TTL
+mailbox_bytes = MAILBOX_MAX_BYTES
+reliable = False    # Chat messages are acknowledged hop by hop and retransmitted
+send_window = SEND_WINDOW
+send_queue_cap = SEND_QUEUE_MAX
+links = {}          # (addr, port) -> ReliableLink
+dup_filters = {}    # (addr, port) of a previous hop -> DupFilter
+stats = collections.Counter()
+latencies = collections.defaultdict(Histogram)  # ev_type -> time spent in its handler
+packets_in = collections.Counter()  # Kind name -> received datagrams
+bytes_in = collections.Counter()
+started = millitime()
+stats_file = None   # Where stats are dumped as JSON every STATS_DUMP_TIME seconds, None disables
+state_file = None   # Where the state is saved every STATE_SAVE_TIME seconds for a warm restart, None disables
+warm_state = None   # StateSnapshot the server was restarted from
+state_writer = None     # Thread building and writing the last state copied by the processor
+servers_version = 0     # Bumped when a server is added to or removed from known_servers
+users_version = 0
+users_log = collections.deque()     # (version, uid) of every added or removed user, oldest first
+users_log_floor = 0                 # Changes since older versions are no longer in users_log
+users_seen = {}     # (addr, port) of a neighbour -> (its id, version of its last KnownUsers)
+datagram_budget = UDP_MAXLEN
+page_seq = itertools.count(1)
+partial_pages = {}  # (addr, seq) -> (time of the first page, {index: GenericMessage})
+partial_pages_lock = threading.Lock()  # Pages arrive on the listener, relay and stream threads
+batch_window = 0    # Seconds outgoing messages to a server wait for others to share a datagram, 0 disables batching
+batch_max_msgs = 64
+out_batches = {}    # (addr, port) -> [serialized messages, size of the batch, flush timer]
+workers = []        # (worker process, pipe for forwarding table changes)
+reuse_port = False
+relay = None        # Datagrams which the workers pass to this process
+relay_thread = None
+stream_links = False    # Messages to neighbours go over TCP connections while they are up
+streams = {}        # (addr, port) of a neighbour, by its name in the config and by its IP -> StreamLink
+stream_lock = threading.Lock()
+stream_thread = None
+stream_wakeup = None    # Socket pair waking the stream thread up when there is something to write
+stream_stop = False
+forwarding = {}     # uid -> (addr, port), as last sent to the workers
+forwarding_dirty = set()    # uids whose entry in forwarding may be stale
+routes_dirty = set()        # sids whose route changed, so did the entries of all their users
+const_msgs = {}     # Kind -> serialized message which never changes
+snapshots = {}      # name -> (version, time of creation, serialized pages)
+subscribers = {}    # uid of a local client subscribed to presence -> version of system_users it was sent
+presence_timer = None
+discovery_msgs = {}     # (addr, port) of a neighbour -> (its id and version seen, serialized GetKnownUsers)
+local_groups = {}   # Group name -> uids of local clients which joined it
+flood_seq = itertools.count(pypoly_proto.first_seq())
+flood_seen = SeenCache(FLOOD_SEEN_MAX, FLOOD_SEEN_TTL)
 
 
 def sigint_handler(_, __):
@@ -95,44 +572,150 @@ def listener(port):
     # Listener is waiting for messages from other servers
     # As soon as it gets something, it puts it into queue
     print('Listener started on port', port, '...')
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind(('', port))
+    s = bind_server_socket(port)
 
     while True:
-        data, client_addr = s.recvfrom(UDP_MAXLEN)
-        msg = rolypoly_pb2.GenericMessage()
-        msg.ParseFromString(data)
-        if msg.type == 'EOF':
+        data, client_addr = s.recvfrom(UDP_RECV_MAXLEN)
+        ev = parse_datagram(data, client_addr)
+        if ev is EOF:
             break
-        elif msg.type == 'GetKnownServers':
-            q.put(Event('SEND_KNOWN_SERVERS', content=SocketInfo(client_addr[0], msg.port)))
-        elif msg.type == 'GetKnownUsers':
-            q.put(Event('SEND_KNOWN_USERS', content=SocketInfo(client_addr[0], msg.port)))
-        elif msg.type == 'KnownServers':
-            q.put(Event('MERGE_KNOWN_SERVERS', content=parse_known_servers(msg.known_servers.servers)))
-        elif msg.type == 'KnownUsers':
-            q.put(Event('MERGE_KNOWN_USERS', content=parse_known_users(msg.known_users.users)))
-        elif msg.type == 'ConnectRequest':
-            q.put(Event('ADD_NEW_CLIENT', content=parse_connect_request(*client_addr, msg.connect_request)))
-        elif msg.type == 'Pong':
-            q.put(Event('CLIENT_ALIVE', content=msg.u_id))
-        elif msg.type == 'NewSystemUserInfo':
-            q.put(Event('NEW_SYSTEM_USER', content=parse_new_system_user_info(msg.new_system_user_info)))
-        elif msg.type == 'DelSystemUserInfo':
-            q.put(Event('DEL_SYSTEM_USER', content=msg.u_id))
-        elif msg.type == 'CountHops':
-            q.put(Event('RETURN_HOPS', content=(SocketInfo(client_addr[0], msg.hops.port), msg.hops.s_id)))
-        elif msg.type == 'HopsFrom':
-            q.put(Event('UPDATE_HOPS', content=(SocketInfo(client_addr[0], msg.hops.port), msg.hops.s_id, msg.hops.hops)))
-        elif msg.type == 'Message':
-            q.put(Event('SEND_MESSAGE', content=(msg.message.sender_id, msg.message.receiver_id, msg.message.text)))
-        elif msg.type == 'GetUserList':
-            q.put(Event('SEND_USER_LIST', content=SocketInfo(*client_addr)))
+        elif ev is not None:
+            q.put(ev)
 
     s.close()
     print('Listener stopped')
 
 
+EOF = Event('EOF')
+
+
+def parse_datagram(data, client_addr):
+    kind, msg = pypoly_proto.parse(data)
+    name = pypoly_proto.TYPE_NAMES.get(kind, 'Unknown')
+    packets_in[name] += 1
+    bytes_in[name] += len(data)
+    if msg.HasField('flood') and flood_seen.duplicate((msg.flood.origin, msg.flood.seq)):
+        stats['flood_suppressed.' + name] += 1
+        stats['flood_suppressed_bytes'] += len(data)
+        return None
+    parser = DATAGRAM_PARSERS.get(kind)
+    if parser is None:
+        return None
+    return parser(msg, client_addr)
+
+
+def parse_get_known_users(msg, client_addr):
+    if msg.HasField('users_digest'):
+        digest = msg.users_digest
+        return Event('SEND_KNOWN_USERS', content=(SocketInfo(client_addr[0], digest.port), digest.s_id, digest.version))
+    return Event('SEND_KNOWN_USERS', content=(SocketInfo(client_addr[0], msg.port), 0, 0))
+
+
+def parse_known_users_msg(msg, client_addr):
+    if msg.known_users.page.count > 1:
+        msg = reassemble(msg, 'known_users', client_addr)
+        if msg is None:
+            return None
+    ku = msg.known_users
+    origin = ((client_addr[0], ku.port), ku.s_id, ku.version, ku.full) if ku.port else None
+    alive = parse_known_servers(ku.alive)
+    return Event('MERGE_KNOWN_USERS', content=(parse_known_users(ku.users), list(ku.removed), alive, origin))
+
+
+def parse_batch(msg, client_addr):
+    events = [parse_datagram(data, client_addr) for data in msg.batch.envelopes]
+    return Event('BATCH', content=[ev for ev in events if ev is not None and ev is not EOF])
+
+
+def parse_route_vector(msg, client_addr):
+    rv = msg.route_vector
+    routes = {route.s_id: route.hops for route in rv.routes}
+    return Event('MERGE_ROUTES', content=(SocketInfo(client_addr[0], rv.port), rv.s_id, routes))
+
+
+DATAGRAM_PARSERS = {
+    rolypoly_pb2.KIND_EOF: lambda msg, addr: EOF,
+    rolypoly_pb2.KIND_GET_KNOWN_SERVERS:
+        lambda msg, addr: Event('SEND_KNOWN_SERVERS', content=SocketInfo(addr[0], msg.port)),
+    rolypoly_pb2.KIND_GET_KNOWN_USERS: parse_get_known_users,
+    rolypoly_pb2.KIND_KNOWN_SERVERS:
+        lambda msg, addr: Event('MERGE_KNOWN_SERVERS', content=parse_known_servers(msg.known_servers.servers)),
+    rolypoly_pb2.KIND_KNOWN_USERS: parse_known_users_msg,
+    rolypoly_pb2.KIND_CONNECT_REQUEST:
+        lambda msg, addr: Event('ADD_NEW_CLIENT', content=parse_connect_request(*addr, msg.connect_request)),
+    rolypoly_pb2.KIND_PONG: lambda msg, addr: Event('CLIENT_ALIVE', content=msg.u_id),
+    rolypoly_pb2.KIND_NEW_SYSTEM_USER_INFO:
+        lambda msg, addr: Event('NEW_SYSTEM_USER', content=(parse_new_system_user_info(msg.new_system_user_info),
+                                                            flood_id(msg))),
+    rolypoly_pb2.KIND_DEL_SYSTEM_USER_INFO:
+        lambda msg, addr: Event('DEL_SYSTEM_USER', content=(msg.u_id, flood_id(msg))),
+    rolypoly_pb2.KIND_COUNT_HOPS:
+        lambda msg, addr: Event('RETURN_HOPS', content=(SocketInfo(addr[0], msg.hops.port), msg.hops.s_id,
+                                                        flood_id(msg))),
+    rolypoly_pb2.KIND_HOPS_FROM:
+        lambda msg, addr: Event('UPDATE_HOPS', content=(SocketInfo(addr[0], msg.hops.port), msg.hops.s_id,
+                                                        msg.hops.hops)),
+    rolypoly_pb2.KIND_ROUTE_VECTOR: parse_route_vector,
+    rolypoly_pb2.KIND_BATCH: parse_batch,
+    rolypoly_pb2.KIND_MESSAGE: lambda msg, addr: parse_message(msg.message, addr),
+    rolypoly_pb2.KIND_ACK: lambda msg, addr: Event('ACK', content=((addr[0], msg.ack.port or addr[1]), msg.ack.seq)),
+    rolypoly_pb2.KIND_GET_USER_LIST:
+        lambda msg, addr: Event('SEND_USER_LIST', content=(SocketInfo(*addr), msg.page_range.first,
+                                                           msg.page_range.count)),
+    rolypoly_pb2.KIND_SUBSCRIBE:
+        lambda msg, addr: Event('SUBSCRIBE', content=(msg.subscribe.u_id, msg.subscribe.s_id, msg.subscribe.since)),
+    rolypoly_pb2.KIND_GET_STATS: lambda msg, addr: Event('SEND_STATS', content=SocketInfo(*addr)),
+    rolypoly_pb2.KIND_GROUP_MESSAGE: lambda msg, addr: parse_group_message(msg.group_message),
+    rolypoly_pb2.KIND_JOIN_GROUP:
+        lambda msg, addr: Event('JOIN_GROUP', content=(msg.group_membership.u_id, msg.group_membership.group)),
+    rolypoly_pb2.KIND_LEAVE_GROUP:
+        lambda msg, addr: Event('LEAVE_GROUP', content=(msg.group_membership.u_id, msg.group_membership.group)),
+    rolypoly_pb2.KIND_RESOLVE_USER:
+        lambda msg, addr: Event('RESOLVE_USER', content=(SocketInfo(*addr), msg.resolve_user.name,
+                                                         msg.resolve_user.prefix, msg.resolve_user.limit)),
+}
+
+
+def reassemble(msg, body_name, client_addr):
+    # Returns the whole response merged from all its pages, or None while some are still missing
+    page = getattr(msg, body_name).page
+    key = (client_addr, page.seq)
+    now = time.monotonic()
+    with partial_pages_lock:
+        if key not in partial_pages:
+            for k in [k for k in partial_pages if now - partial_pages[k][0] > PAGE_REASSEMBLY_TIME]:
+                del partial_pages[k]
+            if len(partial_pages) >= PAGE_MAX_PARTIAL:
+                del partial_pages[next(iter(partial_pages))]
+            partial_pages[key] = (now, {})
+        pages = partial_pages[key][1]
+        pages[page.index] = msg
+        if len(pages) < page.count:
+            return None
+        del partial_pages[key]
+
+    whole = rolypoly_pb2.GenericMessage()
+    for i in range(page.count):
+        whole.MergeFrom(pages[i])   # Repeated fields are concatenated
+    getattr(whole, body_name).ClearField('page')
+    return whole
+
+
+def parse_message(m, client_addr):
+    content = (m.sender_id, m.receiver_id, m.text)
+    if m.seq == 0:
+        return Event('SEND_MESSAGE', content=content)
+    return Event('RELIABLE_MESSAGE', content=((client_addr[0], m.port or client_addr[1]), m.seq, content))
+
+
+def parse_group_message(gm):
+    return Event('GROUP_MESSAGE', content=(gm.sender_id, list(gm.receiver_ids), gm.group, list(gm.s_ids), gm.text))
+
+
+def flood_id(msg):
+    return (msg.flood.origin, msg.flood.seq) if msg.HasField('flood') else None
+
+
 def parse_known_servers(ks_proto):
     ks = {}
     for i in range(len(ks_proto)):
@@ -152,7 +735,7 @@ def parse_known_users(ku_proto):
 
 def parse_connect_request(addr, port, cr_proto):
     socketinfo = SocketInfo(addr, port)
-    return ClientInfo(cr_proto.u_id, cr_proto.username, socketinfo, millitime())
+    return ClientInfo(cr_proto.u_id, cr_proto.username, socketinfo, millitime(), cr_proto.reliable)
 
 
 def parse_new_system_user_info(info):
@@ -165,7 +748,36 @@ def process():
 
     global proc_sock
     proc_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start_processing()
+
+    while True:
+        try:
+            ev = q.get(timeout=timers.next_delay())
+        except queue.Empty:
+            pass
+        else:
+            if ev is None:
+                break
+            stats['queue_depth_max'] = max(stats['queue_depth_max'], q.qsize() + 1)
+            handle_event(ev)
+        run_timers()
+
+    if state_file is not None:
+        write_final_state()
+    stop_streams()
+    proc_sock.close()
+    print('Processor stopped')
+
+
+def start_processing():
+    global relay_thread
+    if stream_links:
+        start_streams()
     clear_rout_table()
+    build_const_msgs()
+    if warm_state is not None:
+        restore_routes(warm_state)
+        push_presence()     # Versions were skipped on restore, so restored subscribers get full presence
 
     server_discovery()
     client_discovery()
@@ -175,295 +787,1497 @@ def process():
     remove_inactive_clients()
     remove_inactive_users()
 
-    while True:
-        ev = q.get()
-        if ev is None:
-            break
-        # print(ev)
-        if ev.ev_type == 'SERVER_DISCOVERY':
-            server_discovery()
-        elif ev.ev_type == 'CLIENT_DISCOVERY':
-            client_discovery()
-        elif ev.ev_type == 'USER_DISCOVERY':
-            user_discovery()
-        elif ev.ev_type == 'SEND_KNOWN_SERVERS':
-            send_known_servers(ev.content)
-        elif ev.ev_type == 'SEND_KNOWN_USERS':
-            send_known_users(ev.content)
-        elif ev.ev_type == 'MERGE_KNOWN_SERVERS':
-            merge_known_servers(ev.content)
-        elif ev.ev_type == 'MERGE_KNOWN_USERS':
-            merge_known_users(ev.content)
-        elif ev.ev_type == 'REMOVE_INACTIVE_SERVERS':
-            remove_inactive_servers()
-        elif ev.ev_type == 'REMOVE_INACTIVE_CLIENTS':
-            remove_inactive_clients()
-        elif ev.ev_type == 'REMOVE_INACTIVE_USERS':
-            remove_inactive_users()
-        elif ev.ev_type == 'ADD_NEW_CLIENT':
-            add_new_client(ev.content)
-        elif ev.ev_type == 'CLIENT_ALIVE':
-            client_alive(ev.content)
-        elif ev.ev_type == 'NEW_SYSTEM_USER':
-            new_system_user(ev.content)
-        elif ev.ev_type == 'DEL_SYSTEM_USER':
-            del_system_user(ev.content)
-        elif ev.ev_type == 'RETURN_HOPS':
-            return_hops(*ev.content)
-        elif ev.ev_type == 'UPDATE_HOPS':
-            update_hops(*ev.content)
-        elif ev.ev_type == 'SEND_MESSAGE':
-            send_msg(*ev.content)
-        elif ev.ev_type == 'SEND_USER_LIST':
-            send_user_list(ev.content)
-        else:
-            raise NotImplementedError('This kind of event is not supported: ' + ev.ev_type)
-        q.task_done()
+    advertise_routes()
+    expire_routes()
+    if stats_file is not None:
+        dump_stats()
+    if state_file is not None:
+        save_state()
+
+    if workers:
+        relay_thread = threading.Thread(target=relay_listener)
+        relay_thread.start()
+        sync_workers(full=True)
+
+
+def handle_batch(events):
+    for ev in events:
+        handle_event(ev)
+
+
+def run_timers():
+    for ev in timers.pop_due():
+        handle_event(ev)
+
+
+def schedule(delay, event):
+    return timers.add(delay, event)
+
+
+def handle_event(ev):
+    # print(ev)
+    handler = EVENT_HANDLERS.get(ev.ev_type)
+    if handler is None:
+        raise NotImplementedError('This kind of event is not supported: ' + ev.ev_type)
+    start = time.perf_counter_ns()
+    handler(ev.content)
+    latencies[ev.ev_type].add((time.perf_counter_ns() - start) // 1000)
+
+
+EVENT_HANDLERS = {
+    'SERVER_DISCOVERY': lambda content: server_discovery(),
+    'CLIENT_DISCOVERY': lambda content: client_discovery(),
+    'USER_DISCOVERY': lambda content: user_discovery(),
+    'SEND_KNOWN_SERVERS': lambda content: send_known_servers(content),
+    'SEND_KNOWN_USERS': lambda content: send_known_users(*content),
+    'MERGE_KNOWN_SERVERS': lambda content: merge_known_servers(content),
+    'MERGE_KNOWN_USERS': lambda content: merge_known_users(*content),
+    'REMOVE_INACTIVE_SERVERS': lambda content: remove_inactive_servers(),
+    'REMOVE_INACTIVE_CLIENTS': lambda content: remove_inactive_clients(),
+    'REMOVE_INACTIVE_USERS': lambda content: remove_inactive_users(),
+    'ADD_NEW_CLIENT': lambda content: add_new_client(content),
+    'CLIENT_ALIVE': lambda content: client_alive(content),
+    'CLIENTS_ALIVE': lambda content: clients_alive(content),
+    'NEW_SYSTEM_USER': lambda content: new_system_user(*content),
+    'DEL_SYSTEM_USER': lambda content: del_system_user(*content),
+    'RETURN_HOPS': lambda content: return_hops(*content),
+    'UPDATE_HOPS': lambda content: update_hops(*content),
+    'SEND_MESSAGE': lambda content: send_msg(*content),
+    'RELIABLE_MESSAGE': lambda content: got_reliable_msg(*content),
+    'GROUP_MESSAGE': lambda content: group_msg(*content),
+    'JOIN_GROUP': lambda content: join_group(*content),
+    'LEAVE_GROUP': lambda content: leave_group(*content),
+    'ACK': lambda content: got_ack(*content),
+    'RETRANSMIT': lambda content: retransmit(*content),
+    'SEND_USER_LIST': lambda content: send_user_list(*content),
+    'RESOLVE_USER': lambda content: resolve_user(*content),
+    'SUBSCRIBE': lambda content: subscribe(*content),
+    'PUSH_PRESENCE': lambda content: push_presence(),
+    'RETRY_ROUTE': lambda content: retry_route(content),
+    'EXPIRE_MAILBOX': lambda content: expire_mailbox(content),
+    'ADVERTISE_ROUTES': lambda content: advertise_routes(content),
+    'MERGE_ROUTES': lambda content: merge_routes(*content),
+    'EXPIRE_ROUTES': lambda content: expire_routes(),
+    'BATCH': lambda content: handle_batch(content),
+    'FLUSH_BATCH': lambda content: flush_batch(content),
+    'SYNC_WORKERS': lambda content: sync_workers(),
+    'SEND_STATS': lambda content: send_stats(content),
+    'DUMP_STATS': lambda content: dump_stats(),
+    'SAVE_STATE': lambda content: save_state(),
+}
 
-    proc_sock.close()
-    print('Processor stopped')
+
+########################################################################################################################
+class ServerProtocol(asyncio.DatagramProtocol):
+    # Asyncio engine: receiving, dispatching and sending happen in one event loop, without the queue
+    def connection_made(self, transport):
+        global proc_sock
+        proc_sock = transport   # Handlers send with transport.sendto(), which has the same signature as socket's
+        start_processing()
+        arm_loop_timer()
+
+    def datagram_received(self, data, addr):
+        ev = parse_datagram(data, addr)
+        if ev is EOF:
+            loop.stop()
+        elif ev is not None:
+            handle_loop_event(ev)
+
+
+def handle_loop_event(ev):
+    handle_event(ev)
+    arm_loop_timer()
+
+
+def arm_loop_timer():
+    # A single loop timer is armed for the earliest deadline of the processor's timers
+    global loop_timer
+    deadline = timers.next_deadline()
+    if deadline is None or (loop_timer is not None and loop_timer.when() <= deadline):
+        return
+    if loop_timer is not None:
+        loop_timer.cancel()
+    loop_timer = loop.call_at(deadline, fire_loop_timer)   # Both use time.monotonic()
+
+
+def fire_loop_timer():
+    global loop_timer
+    loop_timer = None
+    run_timers()
+    arm_loop_timer()
+
+
+def run_event_loop(port):
+    global loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print('Asyncio engine started on port', port, '...')
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(ServerProtocol, sock=bind_server_socket(port)))
+    loop.add_signal_handler(signal.SIGINT, loop.stop)   # Wait for SIGINT
+    loop.run_forever()
+    print('\nSIGINT detected, shutting down')
+    stop_workers()  # While the loop is open, the relay thread may still hand it events
+    if state_file is not None:
+        write_final_state()
+    stop_streams()
+    transport.close()
+    loop.close()
+    print('Asyncio engine stopped')
 
 
-def put_event(event):
-    q.put(event)
+########################################################################################################################
+def send_datagram(data, addr):
+    proc_sock.sendto(data, addr)
+    stats['datagrams_out'] += 1
+    stats['bytes_out'] += len(data)
+
+
+def send_server(data, addr):
+    # Messages to other servers may be delayed by batch_window to be sent together in one Batch datagram
+    link = streams.get(addr)
+    if link is not None and link.connected:
+        stream_send(link, data)
+        return
+    if link is not None and len(data) > datagram_budget:
+        stats['stream_fallback_dropped'] += 1   # Paged for the stream, which went down before the page was sent
+        return
+    size = len(data) + BATCH_ENVELOPE_OVERHEAD
+    if batch_window <= 0 or BATCH_OVERHEAD + size > datagram_budget:
+        send_datagram(data, addr)
+        return
+
+    batch = out_batches.get(addr)
+    if batch is not None and batch[1] + size > datagram_budget:
+        stats['batch_flushed_full'] += 1
+        flush_batch(addr)
+        batch = None
+    if batch is None:
+        batch = out_batches[addr] = [[], BATCH_OVERHEAD, schedule(batch_window, Event('FLUSH_BATCH', content=addr))]
+    batch[0].append(data)
+    batch[1] += size
+    if len(batch[0]) >= batch_max_msgs:
+        stats['batch_flushed_full'] += 1
+        flush_batch(addr)
+
+
+def flush_batch(addr):
+    batch = out_batches.pop(addr, None)
+    if batch is None:
+        return
+    timers.cancel(batch[2])
+    if len(batch[0]) == 1:
+        send_datagram(batch[0][0], addr)
+    else:
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_BATCH)
+        msg.batch.envelopes.extend(batch[0])
+        send_datagram(msg.SerializeToString(), addr)
+    stats['batch_datagrams'] += 1
+    stats['batch_messages'] += len(batch[0])
+
+
+def build_const_msgs():
+    for kind in rolypoly_pb2.KIND_PING, rolypoly_pb2.KIND_CONNECTED:
+        const_msgs[kind] = pypoly_proto.new_msg(kind).SerializeToString()
+    if reliable:
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_CONNECTED)
+        msg.reliable = True
+        const_msgs[rolypoly_pb2.KIND_CONNECTED] = msg.SerializeToString()
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GET_KNOWN_SERVERS)
+    msg.port = my_port
+    const_msgs[rolypoly_pb2.KIND_GET_KNOWN_SERVERS] = msg.SerializeToString()
+
+
+def cached_snapshot(name, version, max_age, build):
+    # Serialized pages of a table are reused until the table changes, or until they get older than max_age
+    cached = snapshots.get(name)
+    now = time.monotonic()
+    if cached is not None and cached[0] == version and (max_age is None or now - cached[1] <= max_age):
+        stats['snapshot_hits'] += 1
+        return cached[2]
+    stats['snapshot_misses'] += 1
+    pages = build()
+    snapshots[name] = (version, now, pages)
+    return pages
 
 
 def server_discovery():
     for nb in nbs:
-        msg = rolypoly_pb2.GenericMessage()
-        msg.type = 'GetKnownServers'
-        msg.port = my_port
-        proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
-    threading.Timer(SERV_DISCOVERY_TIME, put_event, args=[Event('SERVER_DISCOVERY')]).start()
+        send_server(const_msgs[rolypoly_pb2.KIND_GET_KNOWN_SERVERS], (nb.addr, nb.port))
+    schedule(SERV_DISCOVERY_TIME, Event('SERVER_DISCOVERY'))
 
 
 def client_discovery():
-    for cid in my_clients:
-        msg = rolypoly_pb2.GenericMessage()
-        msg.type = 'Ping'
-        proc_sock.sendto(msg.SerializeToString(), (my_clients[cid].socketinfo.addr, my_clients[cid].socketinfo.port))
-    threading.Timer(CLIENT_DISCOVERY_TIME, put_event, args=[Event('CLIENT_DISCOVERY')]).start()
+    # Only idle clients are pinged, each when its own lease runs low, so pings do not come in bursts
+    curtime = millitime()
+    for cid in clients_idle.pop_expired(curtime):
+        si = my_clients[cid].socketinfo
+        send_datagram(const_msgs[rolypoly_pb2.KIND_PING], (si.addr, si.port))
+        clients_idle.push(cid, curtime)     # Pinged again after another CLIENT_IDLE_TIME of silence
+        stats['client_pings'] += 1
+    schedule(CLIENT_PING_TICK, Event('CLIENT_DISCOVERY'))
 
 
 def user_discovery():
     for nb in nbs:
-        msg = rolypoly_pb2.GenericMessage()
-        msg.type = 'GetKnownUsers'
-        msg.port = my_port
-        proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
-    threading.Timer(USERS_DISCOVERY_TIME, put_event, args=[Event('USER_DISCOVERY')]).start()
+        seen = users_seen.get((nb.addr, nb.port), (0, 0))
+        cached = discovery_msgs.get((nb.addr, nb.port))
+        if cached is None or cached[0] != seen:
+            msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GET_KNOWN_USERS)
+            msg.users_digest.port = my_port
+            msg.users_digest.s_id, msg.users_digest.version = seen
+            cached = discovery_msgs[(nb.addr, nb.port)] = (seen, msg.SerializeToString())
+        send_server(cached[1], (nb.addr, nb.port))
+    schedule(USERS_DISCOVERY_TIME, Event('USER_DISCOVERY'))
 
 
 def send_known_servers(receiver):
+    for page in cached_snapshot('known_servers', servers_version, SNAPSHOT_MAX_AGE, build_known_servers):
+        send_server(page, (receiver.addr, receiver.port))
+
+
+def build_known_servers():
     known_servers[my_id] = millitime()  # Update my alive timestamp
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'KnownServers'
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_KNOWN_SERVERS)
     for i, sid in enumerate(known_servers):
         msg.known_servers.servers.add()
         msg.known_servers.servers[i].s_id = sid
         msg.known_servers.servers[i].last_alive = known_servers[sid]
+    return [msg.SerializeToString()]
+
 
-    proc_sock.sendto(msg.SerializeToString(), (receiver.addr, receiver.port))
+def send_known_users(receiver, sid=0, since=0):
+    budget = budget_for((receiver.addr, receiver.port))
+    if sid == my_id and users_log_floor <= since <= users_version:
+        pages = cached_snapshot('known_users_delta/%d' % budget, (since, users_version), SNAPSHOT_MAX_AGE,
+                                lambda: build_known_users(since, budget))
+        stats['known_users_delta'] += 1
+    else:   # The requester has not seen my table yet, or it is too far behind
+        pages = cached_snapshot('known_users/%d' % budget, users_version, SNAPSHOT_MAX_AGE,
+                                lambda: build_known_users(None, budget))
+        stats['known_users_full'] += 1
+    for page in pages:
+        send_server(page, (receiver.addr, receiver.port))
 
 
-def send_known_users(receiver):
+def build_known_users(since, budget=None):
     curtime = millitime()
-    for c in my_clients:    # Update my clients timestamps
-        system_users[c].last_alive = curtime
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_KNOWN_USERS)
+    msg.known_users.s_id = my_id
+    msg.known_users.port = my_port
+    msg.known_users.version = users_version
+    if since is not None:
+        changed = users_changed_since(since)
+        alive = {}
+        for s_id in system_users.servers():
+            last_alive = curtime if s_id == my_id else known_servers.get(s_id)
+            if last_alive is not None:
+                alive[s_id] = last_alive
+        for uid in changed:
+            if uid in system_users:
+                add_user_proto(msg.known_users.users.add(), system_users[uid], curtime)
+            else:
+                msg.known_users.removed.append(uid)
+        for s_id in alive:
+            server = msg.known_users.alive.add()
+            server.s_id = s_id
+            server.last_alive = alive[s_id]
+    else:
+        msg.known_users.full = True
+        for uid in system_users:
+            add_user_proto(msg.known_users.users.add(), system_users[uid], curtime)
+    return make_pages(msg, 'known_users', ['users', 'removed', 'alive'], budget)
+
+
+def users_changed_since(since):
+    changed = set()
+    for version, uid in reversed(users_log):
+        if version <= since:
+            break
+        changed.add(uid)
+    return changed
 
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'KnownUsers'
-    for i, uid in enumerate(system_users):
-        suinfo = system_users[uid]
-        msg.known_users.users.add()
-        msg.known_users.users[i].u_id = suinfo.uid
-        msg.known_users.users[i].username = suinfo.name
-        msg.known_users.users[i].s_id = suinfo.sid
-        msg.known_users.users[i].last_alive = suinfo.last_alive
 
-    proc_sock.sendto(msg.SerializeToString(), (receiver.addr, receiver.port))
+def add_user_proto(user, suinfo, curtime):
+    user.u_id = suinfo.uid
+    user.username = suinfo.name
+    user.s_id = suinfo.sid
+    # My clients are alive now, other users as long as their server
+    user.last_alive = curtime if suinfo.sid == my_id else known_servers.get(suinfo.sid, suinfo.last_alive)
 
 
 def merge_known_servers(other_servers):
+    global servers_version
+    curtime = millitime()
     for sid in other_servers:
+        if curtime - other_servers[sid] > SERV_MAX_ALIVE_TIME * 1000:
+            continue    # Already gone, neighbours which have not expired it yet must not bring it back
         if sid not in known_servers:
             known_servers[sid] = other_servers[sid]
-            clear_rout_table()
+            servers_expiry.push(sid, other_servers[sid])
+            servers_version += 1
             print('# Server', sid, ' connected #')
         else:
             known_servers[sid] = max(known_servers[sid], other_servers[sid])
 
 
-def merge_known_users(other_users):
+def merge_known_users(other_users, removed=(), alive=None, origin=None):
+    servers_alive = dict(alive or {})   # A user is alive as long as its server, so only servers are refreshed
     for uid in other_users:
-        if other_users[uid].sid != my_id:
+        sid = other_users[uid].sid
+        if sid != my_id:
+            servers_alive[sid] = max(servers_alive.get(sid, 0), other_users[uid].last_alive)
             if uid not in system_users:
-                system_users[uid] = other_users[uid]
+                add_system_user(other_users[uid])
+                log_user_change(uid)
                 print('# User', system_users[uid].name, '<id: ' + str(uid) + '>', 'connected #')
-            else:
-                system_users[uid].last_alive = max(system_users[uid].last_alive, other_users[uid].last_alive)
+                drain_mailbox(uid)
+
+    for uid in removed:
+        if uid in system_users and system_users[uid].sid != my_id:
+            print('# User', system_users[uid].name, '<id: ' + str(uid) + '> disconnected #')
+            del system_users[uid]
+            log_user_change(uid)
+
+    servers_alive.pop(my_id, None)
+    merge_known_servers(servers_alive)
+
+    # A delta answering a request sent before users_seen was reset must not mark the full table as seen
+    if origin is not None and (origin[3] or origin[0] in users_seen):
+        users_seen[origin[0]] = origin[1:3]
+
+
+def log_user_change(uid):
+    global users_version, users_log_floor, presence_timer
+    users_version += 1
+    users_log.append((users_version, uid))
+    if workers:
+        forwarding_dirty.add(uid)
+    if len(users_log) > USERS_LOG_LEN:
+        users_log_floor = users_log.popleft()[0]
+    if subscribers and presence_timer is None:
+        presence_timer = schedule(PRESENCE_PUSH_TIME, Event('PUSH_PRESENCE'))
 
 
 def remove_inactive_servers():
+    global servers_version
     known_servers[my_id] = millitime()
-    curtime = millitime()
-    for s in list(known_servers):
-        if (curtime - known_servers[s]) > SERV_MAX_ALIVE_TIME * 1000:
-            del known_servers[s]
-            clear_rout_table()
-            print('# Server', s, ' disconnected #')
-    threading.Timer(SERV_DISCOVERY_TIME, put_event, args=[Event('REMOVE_INACTIVE_SERVERS')]).start()
+    for s in servers_expiry.pop_expired(millitime()):
+        del known_servers[s]
+        servers_version += 1
+        removed = system_users.remove_server(s)    # All users of the server went away with it
+        for suinfo in removed:
+            print('# User', suinfo.name, '<id: ' + str(suinfo.uid) + '>', 'disconnected #')
+            log_user_change(suinfo.uid)
+        if removed:
+            forget_users_seen()
+        stats['pending_dropped'] += len(pending_msgs.pop(s, ()))
+        rout_table.pop(s, None)
+        print('# Server', s, ' disconnected #')
+    schedule(SERV_DISCOVERY_TIME, Event('REMOVE_INACTIVE_SERVERS'))
+
+
+def add_system_user(suinfo):
+    if suinfo.sid not in system_users.servers():    # Expiry is tracked per server, not per user
+        users_expiry.push(suinfo.sid, suinfo.last_alive)
+    system_users[suinfo.uid] = suinfo
+
+
+def forget_users_seen():
+    # Users dropped here on my own are not in the changes my neighbours log, so deltas would never bring them back
+    users_seen.clear()
+    stats['users_seen_reset'] += 1
 
 
 def remove_inactive_clients():
-    curtime = millitime()
-    for cid in list(my_clients):
-        if (curtime - my_clients[cid].last_alive) > CLIENT_MAX_ALIVE_TIME * 1000:
-            print('# Client', system_users[cid].name, '<id: ' + str(cid) + '>', 'disconnected #')
-            del my_clients[cid]
+    for cid in clients_expiry.pop_expired(millitime()):
+        print('# Client', my_clients[cid].name, '<id: ' + str(cid) + '>', 'disconnected #')
+        for group in list(my_clients[cid].groups or ()):
+            leave_group(cid, group)
+        si = my_clients.pop(cid).socketinfo
+        if clients_by_addr.get((si.addr, si.port)) == cid:
+            del clients_by_addr[(si.addr, si.port)]
+        forget_peer((si.addr, si.port))
+        subscribers.pop(cid, None)
+        if cid in system_users:
             del system_users[cid]
-            msg = rolypoly_pb2.GenericMessage()
-            msg.type = 'DelSystemUserInfo'
-            msg.u_id = cid
-            for nb in nbs:
-                proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
-    threading.Timer(CLIENT_DISCOVERY_TIME, put_event, args=[Event('REMOVE_INACTIVE_CLIENTS')]).start()
+        log_user_change(cid)
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_DEL_SYSTEM_USER_INFO)
+        msg.u_id = cid
+        flood(msg)
+    schedule(CLIENT_DISCOVERY_TIME, Event('REMOVE_INACTIVE_CLIENTS'))
 
 
 def remove_inactive_users():
-    curtime = millitime()
-    for c in my_clients:
-        system_users[c].last_alive = curtime
-
-    for uid in list(system_users):
-        if (curtime - system_users[uid].last_alive) > USERS_MAX_ALIVE_TIME * 1000:
-            print('# User', system_users[uid].name, '<id: ' + str(uid) + '>', 'disconnected #')
-            del system_users[uid]
-    threading.Timer(USERS_DISCOVERY_TIME, put_event, args=[Event('REMOVE_INACTIVE_USERS')]).start()
+    # Users of a server not heard of for USERS_MAX_ALIVE_TIME go before the server itself, in one step per server
+    expired = users_expiry.pop_expired(millitime())
+    for sid in expired:
+        for suinfo in system_users.remove_server(sid):
+            print('# User', suinfo.name, '<id: ' + str(suinfo.uid) + '>', 'disconnected #')
+            log_user_change(suinfo.uid)
+    if expired:
+        forget_users_seen()
+    schedule(USERS_DISCOVERY_TIME, Event('REMOVE_INACTIVE_USERS'))
 
 
 def add_new_client(clientinfo):
     uid = clientinfo.uid
     name = clientinfo.name
+    if uid in my_clients:   # Connected again, maybe from another address
+        si = my_clients[uid].socketinfo
+        clients_by_addr.pop((si.addr, si.port), None)
+        clientinfo.groups = my_clients[uid].groups
     my_clients[clientinfo.uid] = clientinfo
+    clients_by_addr[(clientinfo.socketinfo.addr, clientinfo.socketinfo.port)] = uid
+    clients_expiry.push(uid, clientinfo.last_alive)
+    clients_idle.push(uid, clientinfo.last_alive)
     system_users[clientinfo.uid] = SystemUserInfo(uid, name, my_id, clientinfo.last_alive)
+    log_user_change(uid)
 
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'Connected'
-    proc_sock.sendto(msg.SerializeToString(), (clientinfo.socketinfo.addr, clientinfo.socketinfo.port))
+    send_datagram(const_msgs[rolypoly_pb2.KIND_CONNECTED], (clientinfo.socketinfo.addr, clientinfo.socketinfo.port))
 
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'NewSystemUserInfo'
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_NEW_SYSTEM_USER_INFO)
     msg.new_system_user_info.u_id = uid
     msg.new_system_user_info.username = name
     msg.new_system_user_info.s_id = my_id
-    for nb in nbs:
-        proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
+    flood(msg)
     print('# Client', name, '<id: ' + str(clientinfo.uid) + '> connected #')
+    drain_mailbox(uid)
 
 
 def client_alive(cid):
+    if cid in my_clients:   # A Pong may come from a client this server no longer knows
+        my_clients[cid].last_alive = millitime()
+
+
+def client_seen(addr):
+    cid = clients_by_addr.get(addr)
+    if cid is not None:
+        my_clients[cid].last_alive = millitime()
+
+
+def clients_alive(cids):
     curtime = millitime()
-    my_clients[cid].last_alive = curtime
+    for cid in cids:
+        if cid in my_clients:
+            my_clients[cid].last_alive = curtime
 
 
-def new_system_user(info):
+def new_system_user(info, flooded=None):
     if info.uid not in system_users:
-        system_users[info.uid] = info
-        msg = rolypoly_pb2.GenericMessage()
-        msg.type = 'NewSystemUserInfo'
+        add_system_user(info)
+        log_user_change(info.uid)
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_NEW_SYSTEM_USER_INFO)
         msg.new_system_user_info.u_id = info.uid
         msg.new_system_user_info.username = info.name
         msg.new_system_user_info.s_id = info.sid
-        for nb in nbs:
-            proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
+        flood(msg, flooded)
         print('# User', system_users[info.uid].name, '<id: ' + str(info.uid) + '>', 'connected #')
+        drain_mailbox(info.uid)
 
 
-def del_system_user(uid):
+def del_system_user(uid, flooded=None):
     if uid in system_users:
         print('# User', system_users[uid].name, '<id: ' + str(uid) + '> disconnected #')
         del system_users[uid]
-        msg = rolypoly_pb2.GenericMessage()
-        msg.type = 'DelSystemUserInfo'
+        log_user_change(uid)
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_DEL_SYSTEM_USER_INFO)
         msg.u_id = uid
-        for nb in nbs:
-            proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
+        flood(msg, flooded)
+
+
+def flood(msg, flooded=None):
+    # Sends to every neighbour, continuing the flood the message came with or starting a new one
+    if flooded is None:
+        flooded = (my_id, next(flood_seq))
+        flood_seen.duplicate(flooded)   # Copies coming back to me are dropped too
+    msg.flood.origin, msg.flood.seq = flooded
+    data = msg.SerializeToString()
+    for nb in nbs:
+        send_server(data, (nb.addr, nb.port))
 
 
 def send_msg(sender_id, receiver_id, text):
+    client_alive(sender_id)
     if receiver_id in system_users:
         if receiver_id in my_clients:
-            msg = rolypoly_pb2.GenericMessage()
-            msg.type = 'Message'
-            msg.message.sender_id = sender_id
-            msg.message.receiver_id = receiver_id
-            msg.message.text = text
-            si = my_clients[receiver_id].socketinfo
-            proc_sock.sendto(msg.SerializeToString(), (si.addr, si.port))
-        elif system_users[receiver_id].sid not in rout_table:
-            find_route(system_users[receiver_id].sid)
-            threading.Timer(MSG_RESEND_TIME, put_event, args=[Event('SEND_MESSAGE', content=(sender_id, receiver_id, text))]).start()
+            client = my_clients[receiver_id]
+            forward_msg((sender_id, receiver_id, text), client.socketinfo, False, client.reliable)
+        elif next_hop(system_users[receiver_id].sid) is None:
+            park_msg(system_users[receiver_id].sid, (sender_id, receiver_id, text))
+        else:
+            forward_msg((sender_id, receiver_id, text), next_hop(system_users[receiver_id].sid), True, True)
+    else:   # Gossip may not have brought the receiver yet
+        store_msg(sender_id, receiver_id, text)
+
+
+def group_msg(sender_id, receiver_ids, group, s_ids, text):
+    # One copy goes to every next hop, carrying the servers and receivers reached through it
+    if not s_ids:   # From a client: a group reaches every server, receivers the servers they are on
+        client_alive(sender_id)
+        if group:
+            targets = set(known_servers).union(system_users.servers())
+        else:
+            targets = {system_users[rid].sid for rid in receiver_ids if rid in system_users}
+    else:
+        targets = set(s_ids)
+    if my_id in targets:
+        targets.discard(my_id)
+        deliver_group_msg(sender_id, receiver_ids, group, text)
+
+    hops = {}   # (addr, port) -> (socketinfo, [sid])
+    for sid in targets:
+        si = next_hop(sid)
+        if si is None:
+            stats['group_unrouted'] += 1
+            continue
+        if (si.addr, si.port) not in hops:
+            hops[(si.addr, si.port)] = (si, [])
+        hops[(si.addr, si.port)][1].append(sid)
+    for si, sids in hops.values():
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GROUP_MESSAGE)
+        msg.group_message.sender_id = sender_id
+        msg.group_message.group = group
+        msg.group_message.text = text
+        msg.group_message.s_ids.extend(sids)
+        sids = set(sids)
+        msg.group_message.receiver_ids.extend(rid for rid in receiver_ids
+                                              if rid in system_users and system_users[rid].sid in sids)
+        send_server(msg.SerializeToString(), (si.addr, si.port))
+        stats['group_copies'] += 1
+
+
+def deliver_group_msg(sender_id, receiver_ids, group, text):
+    local = {rid for rid in receiver_ids if rid in my_clients}
+    local.update(local_groups.get(group, ()))
+    local.discard(sender_id)
+    if not local:
+        return
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_GROUP_MESSAGE)
+    msg.group_message.sender_id = sender_id
+    msg.group_message.group = group
+    msg.group_message.text = text
+    data = msg.SerializeToString()
+    for uid in local:
+        si = my_clients[uid].socketinfo
+        send_datagram(data, (si.addr, si.port))
+    stats['group_delivered'] += len(local)
+
+
+def join_group(uid, group):
+    if uid not in my_clients:
+        return
+    client_alive(uid)
+    client = my_clients[uid]
+    if client.groups is None:
+        client.groups = set()
+    client.groups.add(group)
+    local_groups.setdefault(group, set()).add(uid)
+
+
+def leave_group(uid, group):
+    if uid not in my_clients or group not in (my_clients[uid].groups or ()):
+        return
+    my_clients[uid].groups.discard(group)
+    local_groups[group].discard(uid)
+    if not local_groups[group]:
+        del local_groups[group]
+
+
+def forward_msg(content, si, to_server, acked):
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_MESSAGE)
+    msg.message.sender_id, msg.message.receiver_id, msg.message.text = content
+    if reliable and acked:
+        send_reliable(msg, (si.addr, si.port), to_server)
+    elif to_server:
+        send_server(msg.SerializeToString(), (si.addr, si.port))
+    else:
+        send_datagram(msg.SerializeToString(), (si.addr, si.port))
+
+
+def send_reliable(msg, addr, to_server):
+    link = links.get(addr)
+    if link is None:
+        link = links[addr] = ReliableLink()
+    if len(link.unacked) >= send_window:
+        if len(link.waiting) >= send_queue_cap:
+            stats['reliable_dropped'] += 1
+            link.waiting.popleft()
+        link.waiting.append((msg, to_server))
+        return
+    link.next_seq += 1
+    msg.message.seq = link.next_seq
+    msg.message.port = my_port
+    data = msg.SerializeToString()
+    timer = schedule(link.rtt.rto, Event('RETRANSMIT', content=(addr, link.next_seq)))
+    link.unacked[link.next_seq] = [data, to_server, timer, time.monotonic(), 0]
+    transmit(data, addr, to_server)
+
+
+def transmit(data, addr, to_server):
+    if to_server:
+        send_server(data, addr)
+    else:
+        send_datagram(data, addr)
+
+
+def retransmit(addr, seq):
+    link = links.get(addr)
+    entry = link.unacked.get(seq) if link is not None else None
+    if entry is None:
+        return
+    if entry[4] >= RETRANSMIT_MAX:
+        del link.unacked[seq]
+        stats['reliable_given_up'] += 1
+        send_waiting(addr, link)
+        return
+    entry[4] += 1
+    now = time.monotonic()
+    if entry[3] >= link.backed_off:     # Messages sent before the last backoff time out with the same loss
+        link.rtt.backoff()
+        link.backed_off = now
+    entry[3] = now  # Not sampled anymore after a retransmission, now it tells which loss the message belongs to
+    entry[2] = schedule(link.rtt.rto, Event('RETRANSMIT', content=(addr, seq)))
+    stats['retransmitted'] += 1
+    transmit(entry[0], addr, entry[1])
+
+
+def got_ack(addr, seq):
+    client_seen(addr)
+    link = links.get(addr)
+    entry = link.unacked.pop(seq, None) if link is not None else None
+    if entry is None:
+        return
+    timers.cancel(entry[2])
+    if entry[4] == 0:   # Karn's algorithm: the RTT of a retransmitted message is ambiguous
+        link.rtt.sample(time.monotonic() - entry[3])
+    send_waiting(addr, link)
+
+
+def send_waiting(addr, link):
+    while link.waiting and len(link.unacked) < send_window:
+        msg, to_server = link.waiting.popleft()
+        send_reliable(msg, addr, to_server)
+
+
+def forget_peer(addr):
+    link = links.pop(addr, None)
+    if link is not None:
+        for entry in link.unacked.values():
+            timers.cancel(entry[2])
+    dup_filters.pop(addr, None)
+
+
+def got_reliable_msg(peer, seq, content):
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_ACK)
+    msg.ack.seq = seq
+    msg.ack.port = my_port
+    send_datagram(msg.SerializeToString(), peer)
+    dup_filter = dup_filters.get(peer)
+    if dup_filter is None:
+        dup_filter = dup_filters[peer] = pypoly_proto.DupFilter()
+    if dup_filter.duplicate(seq):
+        stats['duplicates_dropped'] += 1
+        return
+    send_msg(*content)
+
+
+def park_msg(sid, content):
+    pending = pending_msgs.get(sid)
+    if pending is None:     # First message to this server, look for a route once for all of them
+        pending = pending_msgs[sid] = collections.deque()
+        find_route(sid)
+        schedule(ROUTE_RETRY_TIME, Event('RETRY_ROUTE', content=sid))
+    if len(pending) >= pending_cap:
+        stats['pending_dropped'] += 1
+        if pending_drop == 'newest':
+            return
+        pending.popleft()
+    pending.append(content)
+
+
+def store_msg(sender_id, receiver_id, text):
+    if mailbox_ttl <= 0:
+        return
+    text = text.encode()
+    size = len(text) + MAILBOX_MSG_OVERHEAD
+    mailbox = mailboxes.get(receiver_id)
+    if size > mailbox_bytes or (mailbox is None and len(mailboxes) >= MAILBOX_MAX_USERS):
+        stats['mailbox_dropped'] += 1
+        return
+    if mailbox is None:
+        mailbox = mailboxes[receiver_id] = [collections.deque(), 0,
+                                            schedule(mailbox_ttl, Event('EXPIRE_MAILBOX', content=receiver_id))]
+    if mailbox[1] + size > mailbox_bytes:
+        stats['mailbox_dropped'] += 1
+        if pending_drop == 'newest':
+            return
+        while mailbox[1] + size > mailbox_bytes:
+            mailbox[1] -= len(mailbox[0].popleft()[2]) + MAILBOX_MSG_OVERHEAD
+    mailbox[0].append((time.monotonic() + mailbox_ttl, sender_id, text))
+    mailbox[1] += size
+    stats['mailbox_stored'] += 1
+
+
+def expire_mailbox(uid):
+    mailbox = mailboxes.get(uid)
+    if mailbox is None:
+        return
+    now = time.monotonic()
+    msgs = mailbox[0]
+    while msgs and msgs[0][0] <= now:
+        mailbox[1] -= len(msgs.popleft()[2]) + MAILBOX_MSG_OVERHEAD
+        stats['mailbox_expired'] += 1
+    if msgs:
+        mailbox[2] = schedule(msgs[0][0] - now, Event('EXPIRE_MAILBOX', content=uid))
+    else:
+        del mailboxes[uid]
+
+
+def drain_mailbox(uid):
+    # Called as soon as the receiver becomes known
+    mailbox = mailboxes.pop(uid, None)
+    if mailbox is None:
+        return
+    timers.cancel(mailbox[2])
+    now = time.monotonic()
+    for deadline, sender_id, text in mailbox[0]:
+        if deadline > now:
+            stats['mailbox_delivered'] += 1
+            send_msg(sender_id, uid, text.decode())
         else:
-            msg = rolypoly_pb2.GenericMessage()
-            msg.type = 'Message'
-            msg.message.sender_id = sender_id
-            msg.message.receiver_id = receiver_id
-            msg.message.text = text
-            si = rout_table[system_users[receiver_id].sid][1]
-            proc_sock.sendto(msg.SerializeToString(), (si.addr, si.port))
-
-
-def find_route(sid):
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'CountHops'
+            stats['mailbox_expired'] += 1
+
+
+def retry_route(sid):
+    if sid not in pending_msgs:
+        return
+    if sid not in known_servers:
+        stats['pending_dropped'] += len(pending_msgs.pop(sid))
+    else:
+        find_route(sid)
+        schedule(ROUTE_RETRY_TIME, Event('RETRY_ROUTE', content=sid))
+
+
+def flush_pending(sid):
+    pending = pending_msgs.pop(sid, None)
+    if pending is None:
+        return
+    si = next_hop(sid)
+    for content in pending:
+        forward_msg(content, si, True, True)
+
+
+def find_route(sid, flooded=None):
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_COUNT_HOPS)
     msg.hops.s_id = sid
     msg.hops.port = my_port
-    for nb in nbs:
-        proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
+    flood(msg, flooded)
 
 
-def return_hops(socketinfo, sid):
+def return_hops(socketinfo, sid, flooded=None):
     if sid in rout_table:   # I looked for route to this sid already
-        if rout_table[sid] is not None:     # I know working route
-            msg = rolypoly_pb2.GenericMessage()
-            msg.type = 'HopsFrom'
+        if next_hop(sid) is not None:   # I know working route
+            msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_HOPS_FROM)
             msg.hops.s_id = sid
             msg.hops.hops = rout_table[sid][0]
             msg.hops.port = my_port
-            proc_sock.sendto(msg.SerializeToString(), (socketinfo.addr, socketinfo.port))
+            send_server(msg.SerializeToString(), (socketinfo.addr, socketinfo.port))
 
     else:
         rout_table[sid] = None  # Marking as None means "I don't know the route yet, but started looking for it"
-        find_route(sid)
+        route_changed(sid)
+        find_route(sid, flooded)    # The same search goes on, so that its copies can be recognized
 
 
 def update_hops(socketinfo, sid, hops):
     if sid not in rout_table or rout_table[sid] is None or rout_table[sid][0] > hops + 1:
-        rout_table[sid] = (hops + 1, socketinfo)
-        for nb in nbs:
-            msg = rolypoly_pb2.GenericMessage()
-            msg.type = 'HopsFrom'
-            msg.hops.s_id = sid
-            msg.hops.hops = rout_table[sid][0]
-            msg.hops.port = my_port
-            proc_sock.sendto(msg.SerializeToString(), (nb.addr, nb.port))
+        set_route(sid, hops + 1, socketinfo)
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_HOPS_FROM)
+        msg.hops.s_id = sid
+        msg.hops.hops = rout_table[sid][0]
+        msg.hops.port = my_port
+        flood(msg)  # A new flood, as copies with a shorter path may still come with the id the route came with
 
 
 def clear_rout_table():
     global rout_table
-    rout_table = {my_id: (0, SocketInfo('127.0.0.1', my_port))}
+    rout_table = {my_id: (0, SocketInfo('127.0.0.1', my_port), None)}
+
+
+def next_hop(sid):
+    route = rout_table.get(sid)
+    if route is None or route[0] >= ROUTE_INFINITY:
+        return None
+    return route[1]
+
+
+def set_route(sid, hops, socketinfo):
+    global routes_changed
+    route = rout_table.get(sid)
+    if (route is None or route[0] != hops or not route[1].same(socketinfo)) and not routes_changed:
+        routes_changed = True
+        schedule(ROUTE_TRIGGER_DELAY, Event('ADVERTISE_ROUTES', content=False))
+    rout_table[sid] = (hops, socketinfo, millitime())
+    route_changed(sid)
+    if hops < ROUTE_INFINITY:
+        flush_pending(sid)
+
+
+def advertise_routes(periodic=True):
+    # Distance vector with poisoned reverse: routes through a neighbour are advertised back to it as unreachable
+    global routes_changed
+    if periodic:
+        schedule(ROUTE_ADVERT_TIME, Event('ADVERTISE_ROUTES', content=True))
+    elif not routes_changed:
+        return
+    routes_changed = False
+    for nb in nbs:
+        msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_ROUTE_VECTOR)
+        msg.route_vector.s_id = my_id
+        msg.route_vector.port = my_port
+        for sid in rout_table:
+            route = rout_table[sid]
+            if route is not None:
+                route_proto = msg.route_vector.routes.add()
+                route_proto.s_id = sid
+                route_proto.hops = ROUTE_INFINITY if sid != my_id and route[1].same(nb) else route[0]
+        for page in make_pages(msg, 'route_vector', ['routes'], budget_for((nb.addr, nb.port))):
+            send_server(page, (nb.addr, nb.port))
+
+
+def merge_routes(socketinfo, nb_sid, routes):
+    set_route(nb_sid, 1, socketinfo)
+    for sid in routes:
+        if sid == my_id or sid == nb_sid:
+            continue
+        hops = min(routes[sid] + 1, ROUTE_INFINITY)
+        route = rout_table.get(sid)
+        if route is None:
+            if hops < ROUTE_INFINITY:
+                set_route(sid, hops, socketinfo)
+        elif route[1].same(socketinfo) or hops < route[0]:
+            if hops < ROUTE_INFINITY or route[0] < ROUTE_INFINITY:
+                set_route(sid, hops, socketinfo)    # The next hop knows best, also when the route got worse
+
+
+def expire_routes():
+    curtime = millitime()
+    dead_hops = []
+    for sid in list(rout_table):
+        route = rout_table[sid]
+        if sid != my_id and route is not None and (curtime - route[2]) > ROUTE_MAX_AGE * 1000:
+            del rout_table[sid]
+            route_changed(sid)
+            if route[0] == 1:
+                dead_hops.append(route[1])  # The neighbour went silent, so did all routes through it
+    for sid in list(rout_table):
+        route = rout_table[sid]
+        if route is not None and route[0] < ROUTE_INFINITY and any(route[1].same(si) for si in dead_hops):
+            set_route(sid, ROUTE_INFINITY, route[1])
+    schedule(ROUTE_ADVERT_TIME, Event('EXPIRE_ROUTES'))
+
+
+def send_user_list(socketinfo, first=0, count=0):
+    client_seen((socketinfo.addr, socketinfo.port))
+    pages = cached_snapshot('user_list', users_version, None, build_user_list)
+    for page in pages[first:first + count] if count else pages[first:]:
+        send_datagram(page, (socketinfo.addr, socketinfo.port))
+
+
+def build_user_list():
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_USER_LIST)
+    for uid in system_users:
+        user = msg.userlist.users.add()
+        user.s_id = uid
+        user.username = system_users[uid].name
+    return make_pages(msg, 'userlist', ['users'])
+
+
+def resolve_user(socketinfo, name, prefix, limit):
+    client_seen((socketinfo.addr, socketinfo.port))
+    limit = min(limit, RESOLVE_MAX_RESULTS) if limit > 0 else RESOLVE_MAX_RESULTS
+    found = system_users.prefixed(name, limit) if prefix else system_users.named(name)[:limit]
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_RESOLVED_USERS)
+    for suinfo in found:
+        user = msg.userlist.users.add()
+        user.s_id = suinfo.uid
+        user.username = suinfo.name
+    send_datagram(msg.SerializeToString(), (socketinfo.addr, socketinfo.port))
+
+
+def subscribe(uid, sid, since):
+    if uid not in my_clients:
+        return
+    client_alive(uid)
+    send_presence(uid, since if sid == my_id else None)
+
+
+def push_presence():
+    global presence_timer
+    presence_timer = None
+    for uid in list(subscribers):
+        if subscribers[uid] != users_version:
+            send_presence(uid, subscribers[uid])
+
+
+def send_presence(uid, since):
+    if since is not None and users_log_floor <= since <= users_version:
+        pages = cached_snapshot('presence_delta', (since, users_version), None, lambda: build_presence(since))
+        stats['presence_delta'] += 1
+    else:   # A new subscriber, or one too far behind
+        pages = cached_snapshot('presence', users_version, None, lambda: build_presence(None))
+        stats['presence_full'] += 1
+    subscribers[uid] = users_version
+    si = my_clients[uid].socketinfo
+    for page in pages:
+        send_datagram(page, (si.addr, si.port))
+
+
+def build_presence(since):
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_PRESENCE)
+    msg.presence.s_id = my_id
+    msg.presence.version = users_version
+    if since is None:
+        msg.presence.full = True
+        changed = system_users
+    else:
+        msg.presence.since = since
+        changed = users_changed_since(since)
+    for uid in changed:
+        if uid in system_users:
+            user = msg.presence.joined.add()
+            user.s_id = uid
+            user.username = system_users[uid].name
+        else:
+            msg.presence.left.append(uid)
+    return make_pages(msg, 'presence', ['joined', 'left'])
+
+
+def make_pages(msg, body_name, fields, budget=None):
+    # Splits the repeated fields of a response between datagrams that fit in the budget, datagram_budget by default
+    budget = budget or datagram_budget
+    if msg.ByteSize() <= budget:
+        return [msg.SerializeToString()]
+
+    body = getattr(msg, body_name)
+    header = rolypoly_pb2.GenericMessage()
+    header.CopyFrom(msg)
+    for name in fields:
+        getattr(header, body_name).ClearField(name)
+    getattr(header, body_name).page.index = 1
+    header_size = header.ByteSize() + 20     # Room for the seq and the number of pages
+
+    pages = []
+    size = budget
+    for name in fields:
+        for item in getattr(body, name):
+            item_size = 11 if isinstance(item, int) else item.ByteSize() + 4
+            if size + item_size > budget:
+                page = rolypoly_pb2.GenericMessage()
+                page.CopyFrom(header)
+                pages.append(page)
+                size = header_size
+            if isinstance(item, int):
+                getattr(getattr(pages[-1], body_name), name).append(item)
+            else:
+                getattr(getattr(pages[-1], body_name), name).add().CopyFrom(item)
+            size += item_size
+
+    seq = next(page_seq)
+    for i, page in enumerate(pages):
+        getattr(page, body_name).page.seq = seq
+        getattr(page, body_name).page.index = i
+        getattr(page, body_name).page.count = len(pages)
+    stats['pages_sent'] += len(pages)
+    return [page.SerializeToString() for page in pages]
+
+
+def collect_stats():
+    counters = dict(stats)
+    counters.update(('packets_in.' + name, packets_in[name]) for name in list(packets_in))
+    counters.update(('bytes_in.' + name, bytes_in[name]) for name in list(bytes_in))
+    counters['queue_depth'] = q.qsize()
+    counters.update(('queue_depth.' + name, depth) for name, depth in q.depths().items())
+    counters['timers_pending'] = timers.pending
+    counters['flood_seen'] = len(flood_seen)
+    counters['known_servers'] = len(known_servers)
+    counters['system_users'] = len(system_users)
+    counters['my_clients'] = len(my_clients)
+    return counters
+
+
+def send_stats(socketinfo):
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_STATS)
+    msg.stats.s_id = my_id
+    msg.stats.uptime = millitime() - started
+    for name, value in sorted(collect_stats().items()):
+        counter = msg.stats.counters.add()
+        counter.name = name
+        counter.value = value
+    for name in sorted(latencies):
+        histogram = msg.stats.histograms.add()
+        histogram.name = name
+        histogram.count = latencies[name].count
+        histogram.total = latencies[name].total
+        histogram.buckets.extend(latencies[name].buckets)
+    send_datagram(msg.SerializeToString(), (socketinfo.addr, socketinfo.port))
+
+
+def dump_stats():
+    dump = {
+        's_id': my_id,
+        'uptime': millitime() - started,
+        'counters': collect_stats(),
+        'histograms': {name: {'count': h.count, 'total': h.total, 'buckets': h.buckets}
+                       for name, h in latencies.items()},
+    }
+    tmp = stats_file + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(dump, f, indent=1, sort_keys=True)
+        os.replace(tmp, stats_file)     # Readers never see a half written file
+    except OSError as e:
+        print('# Stats not dumped:', e, '#')
+    schedule(STATS_DUMP_TIME, Event('DUMP_STATS'))
+
+
+def save_state():
+    # Only copying the tables is left to the processor, the snapshot is serialized and written on another thread
+    global state_writer
+    if state_writer is not None and state_writer.is_alive():
+        stats['state_saves_skipped'] += 1   # The previous one is still being written
+    else:
+        state_writer = threading.Thread(target=write_state, args=(copy_state(),), daemon=True)
+        state_writer.start()
+    schedule(STATE_SAVE_TIME, Event('SAVE_STATE'))
+
+
+def write_final_state():
+    if state_writer is not None:
+        state_writer.join()     # Or it could replace the file with an older state
+    write_state(copy_state())
+
+
+def copy_state():
+    users, users_alive = system_users.copy_columns()
+    clients = [(c.uid, c.name, c.socketinfo.addr, c.socketinfo.port, c.last_alive, c.reliable, list(c.groups or ()),
+                subscribers.get(c.uid)) for c in my_clients.values()]
+    return millitime(), users_version, dict(known_servers), users, users_alive, clients, dict(rout_table)
+
+
+def write_state(state):
+    saved, version, servers, users, users_alive, clients, routes = state
+    snapshot = rolypoly_pb2.StateSnapshot()
+    snapshot.s_id = my_id
+    snapshot.port = my_port
+    snapshot.saved = saved
+    snapshot.users_version = version
+    for sid in servers:
+        server = snapshot.servers.add()
+        server.s_id = sid
+        server.last_alive = servers[sid]
+    for sid in users:
+        if sid != my_id:
+            last_alive = max(servers.get(sid, 0), users_alive[sid])
+            for uid in users[sid]:
+                user = snapshot.users.add()
+                user.u_id = uid
+                user.username = users[sid][uid]
+                user.s_id = sid
+                user.last_alive = last_alive
+    for uid, name, addr, port, last_alive, reliable, groups, presence_version in clients:
+        client = snapshot.clients.add()
+        client.u_id = uid
+        client.username = name
+        client.addr = addr
+        client.port = port
+        client.last_alive = last_alive
+        client.reliable = reliable
+        client.groups.extend(groups)
+        if presence_version is not None:
+            client.subscribed = True
+            client.presence_version = presence_version
+    for sid in routes:
+        route = routes[sid]
+        if sid != my_id and route is not None:
+            saved = snapshot.routes.add()
+            saved.s_id = sid
+            saved.hops = route[0]
+            saved.addr = route[1].addr
+            saved.port = route[1].port
+            saved.refreshed = route[2]
+    tmp = state_file + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(snapshot.SerializeToString())
+        os.replace(tmp, state_file)
+    except OSError as e:
+        print('# State not saved:', e, '#')
+
+
+def load_state(port):
+    # Takes over the identity and tables of the previous run, if it stopped recently enough to still be known
+    global my_id, users_version, users_log_floor, warm_state
+    try:
+        with open(state_file, 'rb') as f:
+            snapshot = rolypoly_pb2.StateSnapshot.FromString(f.read())
+    except FileNotFoundError:
+        return
+    except (OSError, DecodeError) as e:
+        print('# No state restored:', e, '#')
+        return
+    curtime = millitime()
+    if snapshot.port != port or curtime - snapshot.saved > SERV_MAX_ALIVE_TIME * 1000:
+        print('# State in', state_file, 'is too old, starting cold #')
+        return
+
+    my_id = snapshot.s_id
+    known_servers.clear()
+    for server in snapshot.servers:
+        known_servers[server.s_id] = server.last_alive
+        servers_expiry.push(server.s_id, server.last_alive)
+    known_servers[my_id] = curtime
+    for user in snapshot.users:
+        add_system_user(SystemUserInfo(user.u_id, user.username, user.s_id, user.last_alive))
+    for saved in snapshot.clients:
+        client = ClientInfo(saved.u_id, saved.username, SocketInfo(saved.addr, saved.port), saved.last_alive,
+                            saved.reliable)
+        my_clients[client.uid] = client
+        clients_by_addr[(saved.addr, saved.port)] = client.uid
+        clients_expiry.push(client.uid, client.last_alive)
+        clients_idle.push(client.uid, client.last_alive)
+        system_users[client.uid] = SystemUserInfo(client.uid, client.name, my_id, client.last_alive)
+        if saved.groups:
+            client.groups = set(saved.groups)
+            for group in client.groups:
+                local_groups.setdefault(group, set()).add(client.uid)
+        if saved.subscribed:
+            subscribers[client.uid] = saved.presence_version
+    # Changes made after the last save are lost, so versions peers may have seen are skipped: they get full tables
+    users_version = snapshot.users_version + USERS_LOG_LEN
+    users_log_floor = users_version
+    warm_state = snapshot
+    print('# State restored from', state_file, ':', len(known_servers), 'servers,', len(system_users), 'users #')
+
+
+def restore_routes(snapshot):
+    for saved in snapshot.routes:
+        rout_table[saved.s_id] = (saved.hops, SocketInfo(saved.addr, saved.port), saved.refreshed)
 
 
-def send_user_list(socketinfo):
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'UserList'
-    for i, uid in enumerate(system_users):
-        u = system_users[uid]
-        msg.userlist.users.add()
-        msg.userlist.users[i].s_id = uid
-        msg.userlist.users[i].username = u.name
-    proc_sock.sendto(msg.SerializeToString(), (socketinfo.addr, socketinfo.port))
+########################################################################################################################
+def bind_server_socket(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # The kernel spreads datagrams over all processes
+    s.bind(('', port))
+    return s
+
+
+def start_workers(count, port, reliable_mode):
+    # Must be called before any thread is started, worker processes are forked
+    global relay, reuse_port
+    reuse_port = True
+    ctx = multiprocessing.get_context('fork')
+    relay = ctx.Queue()
+    for _ in range(count):
+        updates, updates_sender = ctx.Pipe(duplex=False)
+        p = ctx.Process(target=worker, args=(port, updates, relay, reliable_mode), daemon=True)
+        p.start()
+        workers.append((p, updates_sender))
+    print('Started', count, 'workers')
+
+
+def stop_workers():
+    for _, updates in workers:
+        updates.send(None)
+    for p, _ in workers:
+        p.join()
+    if relay_thread is not None:
+        relay.put(None)
+        relay_thread.join()
+
+
+def worker(port, updates, relayed, reliable_mode):
+    # Worker process forwards chat messages by its copy of the forwarding table, everything else goes to the owner
+    # process, which keeps all the state. In reliable mode every message needs an ack, so all of them go there too.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    s = bind_server_socket(port)
+    table = {}
+    seen = set()    # Senders of forwarded messages, reported so that their leases are renewed
+    reported = time.monotonic()
+    while True:
+        readable, _, _ = select.select([s, updates], [], [], WORKERS_SYNC_TIME)
+        if updates in readable:
+            changes = updates.recv()
+            if changes is None:
+                break
+            for uid in changes:
+                if changes[uid] is None:
+                    table.pop(uid, None)
+                else:
+                    table[uid] = changes[uid]
+        if s in readable:
+            data, client_addr = s.recvfrom(UDP_RECV_MAXLEN)
+            kind, msg = pypoly_proto.parse(data)
+            if (not reliable_mode and kind == rolypoly_pb2.KIND_MESSAGE and msg.message.seq == 0
+                    and msg.message.receiver_id in table):
+                s.sendto(data, table[msg.message.receiver_id])
+                seen.add(msg.message.sender_id)
+            elif kind != rolypoly_pb2.KIND_EOF:     # EOF is meant only for the owner's listener
+                relayed.put((data, client_addr))
+        if seen and time.monotonic() - reported >= WORKERS_SYNC_TIME:
+            relayed.put((None, list(seen)))
+            seen.clear()
+            reported = time.monotonic()
+    s.close()
+
+
+def relay_listener():
+    while True:
+        item = relay.get()
+        if item is None:
+            break
+        ev = parse_datagram(*item) if item[0] is not None else Event('CLIENTS_ALIVE', content=item[1])
+        if ev is not None and ev is not EOF:
+            deliver_event(ev)
+
+
+def deliver_event(ev):
+    # From threads other than the listener and the event loop
+    if loop is not None:
+        loop.call_soon_threadsafe(handle_loop_event, ev)
+    else:
+        q.put(ev)
+
+
+def route_changed(sid):
+    if workers:
+        routes_dirty.add(sid)
+
+
+def sync_workers(full=False):
+    # Sends workers the changes of the forwarding table: uid -> address of the client or of the next hop.
+    # Only entries marked dirty since the last sync are looked at, unless full.
+    uids = set(system_users).union(forwarding) if full else forwarding_dirty
+    for sid in routes_dirty:
+        uids.update(system_users.uids_of(sid))
+    changes = {}
+    for uid in uids:
+        si = None
+        if uid in my_clients:
+            si = my_clients[uid].socketinfo
+        elif uid in system_users:
+            si = next_hop(system_users.sid_of(uid))
+        entry = (si.addr, si.port) if si is not None else None
+        if forwarding.get(uid) != entry:
+            changes[uid] = entry
+            if entry is None:
+                del forwarding[uid]
+            else:
+                forwarding[uid] = entry
+    forwarding_dirty.clear()
+    routes_dirty.clear()
+    if changes:
+        for _, updates in workers:
+            updates.send(changes)
+    schedule(WORKERS_SYNC_TIME, Event('SYNC_WORKERS'))
+
+
+########################################################################################################################
+def start_streams():
+    global stream_thread, stream_wakeup, stream_stop
+    for nb in nbs:
+        link = StreamLink((socket.gethostbyname(nb.addr), nb.port))
+        streams[(nb.addr, nb.port)] = streams[link.addr] = link
+    stream_wakeup = socket.socketpair()
+    for sock in stream_wakeup:
+        sock.setblocking(False)
+    stream_stop = False
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind(('', my_port))
+    lsock.listen()
+    lsock.setblocking(False)
+    stream_thread = threading.Thread(target=stream_io, args=[lsock])
+    stream_thread.start()
+
+
+def stop_streams():
+    global stream_stop
+    if stream_thread is None:
+        return
+    stream_stop = True
+    wake_streams()
+    stream_thread.join()
+
+
+def wake_streams():
+    try:
+        stream_wakeup[1].send(b'\0')
+    except BlockingIOError:
+        pass    # Already woken up
+
+
+def stream_send(link, data):
+    with stream_lock:
+        if link.queued + len(data) > STREAM_MAX_QUEUED:
+            stats['stream_dropped'] += 1
+            return
+        idle = not link.out
+        link.out.append(STREAM_HEADER.pack(len(data)))
+        link.out.append(data)
+        link.queued += STREAM_HEADER.size + len(data)
+    if idle:
+        wake_streams()
+
+
+def budget_for(addr):
+    link = streams.get(addr)
+    return STREAM_BUDGET if link is not None and link.connected else datagram_budget
+
+
+def stream_io(lsock):
+    # Stream thread: connects to neighbours and writes queued frames, accepts neighbours and reads their frames
+    sel = selectors.DefaultSelector()
+    sel.register(lsock, selectors.EVENT_READ)
+    sel.register(stream_wakeup[0], selectors.EVENT_READ)
+    links = set(streams.values())
+    while not stream_stop:
+        now = time.monotonic()
+        for link in links:
+            if link.sock is None and link.retry_at <= now:
+                try:
+                    stream_connect(sel, link)
+                except OSError as e:
+                    print('# Stream error:', e, '#')
+                    stream_failed(sel, link)
+        retries = [link.retry_at for link in links if link.sock is None]
+        for key, events in sel.select(max(0.0, min(retries) - now) if retries else None):
+            try:
+                if key.fileobj is lsock:
+                    conn, peer = lsock.accept()
+                    conn.setblocking(False)
+                    sel.register(conn, selectors.EVENT_READ, [peer, bytearray()])
+                elif key.fileobj is stream_wakeup[0]:
+                    try:
+                        while stream_wakeup[0].recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    for link in links:
+                        if link.connected and link.out:
+                            sel.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, link)
+                elif isinstance(key.data, StreamLink):
+                    stream_ready(sel, key.data, events)
+                else:
+                    stream_read(sel, key.fileobj, *key.data)
+            except Exception as e:  # One broken connection must not end the thread serving all neighbours
+                stream_error(sel, key, e)
+
+    for key in list(sel.get_map().values()):
+        sel.unregister(key.fileobj)
+        key.fileobj.close()
+    sel.close()
+    for link in links:
+        link.sock = None
+        link.connected = False
+    stream_wakeup[1].close()
+
+
+def stream_connect(sel, link):
+    link.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    link.sock.setblocking(False)
+    link.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    link.sock.connect_ex(link.addr)
+    sel.register(link.sock, selectors.EVENT_WRITE, link)
+
+
+def stream_ready(sel, link, events):
+    if not link.connected:
+        if link.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            stream_failed(sel, link)
+            return
+        link.connected = True
+        stats['stream_connects'] += 1
+    if events & selectors.EVENT_READ:   # Neighbours never write to our connections, so this is EOF or an error
+        stream_failed(sel, link)
+        return
+    with stream_lock:
+        buffers = list(itertools.islice(link.out, STREAM_MAX_IOV))
+    try:
+        sent = link.sock.sendmsg(buffers) if buffers else 0
+    except BlockingIOError:
+        sent = 0
+    except OSError:
+        stream_failed(sel, link)
+        return
+    with stream_lock:
+        link.queued -= sent
+        while sent:
+            if sent < len(link.out[0]):
+                link.out[0] = link.out[0][sent:]
+                break
+            sent -= len(link.out.popleft())
+        writing = bool(link.out)
+    sel.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ, link)
+
+
+def stream_error(sel, key, e):
+    print('# Stream error:', e, '#')
+    stats['stream_errors'] += 1
+    if isinstance(key.data, StreamLink):
+        stream_failed(sel, key.data)    # Marked down, so that messages to the neighbour go over UDP meanwhile
+    elif key.data is not None:  # A connection accepted from a neighbour
+        try:
+            sel.unregister(key.fileobj)
+        except (KeyError, ValueError):
+            pass
+        key.fileobj.close()
+
+
+def stream_failed(sel, link):
+    # Messages queued for the neighbour are lost, new ones go over UDP until the connection is back
+    if link.sock is not None:
+        try:
+            sel.unregister(link.sock)
+        except (KeyError, ValueError):
+            pass    # Never registered, or failed on the way
+        link.sock.close()
+        link.sock = None
+    if link.connected:
+        print('# Stream to', link.addr, 'lost #')
+    link.connected = False
+    link.retry_at = time.monotonic() + STREAM_RETRY_TIME
+    with stream_lock:
+        stats['stream_dropped'] += len(link.out) // 2
+        link.out.clear()
+        link.queued = 0
+    stats['stream_failures'] += 1
+
+
+def stream_read(sel, conn, peer, buf):
+    try:
+        data = conn.recv(UDP_RECV_MAXLEN)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    buf += data
+    while len(buf) >= STREAM_HEADER.size:
+        size = STREAM_HEADER.unpack_from(buf)[0]
+        if size > STREAM_MAX_FRAME:
+            data = b''
+            break
+        if len(buf) < STREAM_HEADER.size + size:
+            break
+        ev = parse_datagram(bytes(buf[STREAM_HEADER.size:STREAM_HEADER.size + size]), peer)
+        del buf[:STREAM_HEADER.size + size]
+        if ev is not None and ev is not EOF:
+            deliver_event(ev)
+    if not data:
+        sel.unregister(conn)
+        conn.close()
 
 
 ########################################################################################################################
@@ -472,22 +2286,102 @@ def load_config(config_filename):
         for line in f:
             ln = line.rstrip()
             if ln != '':
-                nbs.append(SocketInfo.from_str(ln))
+                nb = SocketInfo.from_str(ln)
+                nb.addr = socket.gethostbyname(nb.addr)     # Next hops are compared with addresses of datagrams
+                nbs.append(nb)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('port', type=int)
     parser.add_argument('config')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='threads: listener and processor threads joined by a queue, '
+                             'asyncio: single event loop')
+    parser.add_argument('--pending-cap', type=int, default=PENDING_MAX_MSGS,
+                        help='messages kept per destination server while its route is unknown')
+    parser.add_argument('--pending-drop', choices=['oldest', 'newest'], default='oldest',
+                        help='which message is dropped when the pending queue or a mailbox is full')
+    parser.add_argument('--mailbox-ttl', type=float, default=MAILBOX_TTL,
+                        help='seconds messages to a receiver not known yet wait for it, 0 drops them at once')
+    parser.add_argument('--mailbox-bytes', type=int, default=MAILBOX_MAX_BYTES,
+                        help='bytes of messages kept for one receiver not known yet')
+    parser.add_argument('--v2-only', action='store_true',
+                        help='send only the Kind enum, without the type string understood by v1 peers')
+    parser.add_argument('--batch-window', type=float, default=0,
+                        help='milliseconds messages to a server wait to be batched into one datagram, 0 disables')
+    parser.add_argument('--batch-max', type=int, default=64,
+                        help='messages in a batch after which it is sent without waiting for the window')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes sharing the port with SO_REUSEPORT, which forward chat messages')
+    parser.add_argument('--datagram-budget', type=int, default=UDP_MAXLEN,
+                        help='largest datagram sent, bigger user lists are split into pages')
+    parser.add_argument('--stream-links', action='store_true',
+                        help='send messages to neighbours over TCP connections on their port, '
+                             'with pages of up to %d bytes, and UDP while a connection is down' % STREAM_BUDGET)
+    parser.add_argument('--reliable', action='store_true',
+                        help='acknowledge and retransmit chat messages hop by hop, all servers must use it')
+    parser.add_argument('--send-window', type=int, default=SEND_WINDOW,
+                        help='unacknowledged messages per neighbour or client in reliable mode')
+    parser.add_argument('--send-queue', type=int, default=SEND_QUEUE_MAX,
+                        help='messages per neighbour or client waiting for room in the send window, '
+                             'the oldest is dropped beyond')
+    parser.add_argument('--state-file',
+                        help='file where the state is saved every %d s, a restart soon enough takes it over'
+                             % STATE_SAVE_TIME)
+    parser.add_argument('--queue-cap', action='append', default=[], metavar='CLASS=N',
+                        help='events of a class (%s) the threads engine queues at most' % ', '.join(QUEUE_CLASSES))
+    parser.add_argument('--queue-policy', action='append', default=[], metavar='CLASS=POLICY',
+                        help='what a full class does: oldest or newest drops that event, block makes the listener '
+                             'wait and leaves datagrams in the socket buffer')
+    parser.add_argument('--stats-file',
+                        help='file where counters and latency histograms are dumped as JSON every %d s'
+                             % STATS_DUMP_TIME)
     args = parser.parse_args()
+    for arg in args.queue_cap:
+        name, _, cap = arg.partition('=')
+        if name not in QUEUE_CLASSES or not cap.isdigit():
+            parser.error('bad --queue-cap: ' + arg)
+        q.caps[QUEUE_CLASSES.index(name)] = int(cap)
+    for arg in args.queue_policy:
+        name, _, policy = arg.partition('=')
+        if name not in QUEUE_CLASSES or policy not in ('oldest', 'newest', 'block'):
+            parser.error('bad --queue-policy: ' + arg)
+        q.policies[QUEUE_CLASSES.index(name)] = policy
 
     load_config(args.config)
 
+    global state_file
+    state_file = args.state_file
+    if state_file is not None:
+        load_state(args.port)
+
     print('# PyPoly server started #')
     print('# ID:', my_id, '#')
 
-    global my_port
+    global my_port, pending_cap, pending_drop, datagram_budget, batch_window, batch_max_msgs, stats_file
+    global reliable, send_window, send_queue_cap, stream_links, mailbox_ttl, mailbox_bytes
     my_port = args.port
+    stream_links = args.stream_links
+    reliable = args.reliable
+    send_window = args.send_window
+    send_queue_cap = args.send_queue
+    stats_file = args.stats_file
+    pending_cap = args.pending_cap
+    pending_drop = args.pending_drop
+    mailbox_ttl = args.mailbox_ttl
+    mailbox_bytes = args.mailbox_bytes
+    datagram_budget = args.datagram_budget
+    pypoly_proto.send_v1_type = not args.v2_only
+    batch_window = args.batch_window / 1000
+    batch_max_msgs = args.batch_max
+
+    if args.workers > 0:
+        start_workers(args.workers, args.port, args.reliable)
+
+    if args.engine == 'asyncio':
+        run_event_loop(args.port)
+        return 0
 
     threads = []
     pt = threading.Thread(target=process)
@@ -500,11 +2394,11 @@ def main():
     signal.signal(signal.SIGINT, sigint_handler)
     signal.pause()  # Wait for SIGINT
     print('\nSIGINT detected, shutting down')
-    q.put(None)
+    q.close()
+    stop_workers()  # Then the EOF below can reach only the listener
 
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)    # UDP socket
-    msg = rolypoly_pb2.GenericMessage()
-    msg.type = 'EOF'
+    msg = pypoly_proto.new_msg(rolypoly_pb2.KIND_EOF)
     s.sendto(msg.SerializeToString(), ('127.0.0.1', my_port))
     s.close()
 
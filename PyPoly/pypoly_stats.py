@@ -0,0 +1,79 @@
+# Asks a running server for its counters and latency histograms and prints them
+import argparse
+import json
+import socket
+import sys
+
+import pypoly_proto
+import rolypoly_pb2
+
+
+UDP_MAXLEN = 65535
+
+
+def get_stats(addr, port, timeout):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(timeout)
+    try:
+        s.sendto(pypoly_proto.new_msg(rolypoly_pb2.KIND_GET_STATS).SerializeToString(), (addr, port))
+        while True:
+            kind, msg = pypoly_proto.parse(s.recvfrom(UDP_MAXLEN)[0])
+            if kind == rolypoly_pb2.KIND_STATS:
+                return msg.stats
+    finally:
+        s.close()
+
+
+def percentile(buckets, count, fraction):
+    # Upper bound of the bucket holding the sample, in microseconds
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= fraction * count:
+            return 1 << i
+    return 1 << len(buckets)
+
+
+def to_dict(st):
+    return {
+        's_id': st.s_id,
+        'uptime': st.uptime,
+        'counters': {c.name: c.value for c in st.counters},
+        'histograms': {h.name: {'count': h.count, 'total': h.total, 'buckets': list(h.buckets)}
+                       for h in st.histograms},
+    }
+
+
+def print_stats(st):
+    print('Server', st.s_id, 'up for %.1f s' % (st.uptime / 1000))
+    for c in st.counters:
+        print('    %-32s %d' % (c.name, c.value))
+    print('    %-32s %10s %10s %10s %10s' % ('event', 'count', 'avg us', 'p50 us', 'p99 us'))
+    for h in st.histograms:
+        print('    %-32s %10d %10.1f %10d %10d' % (h.name, h.count, h.total / max(h.count, 1),
+                                                    percentile(h.buckets, h.count, 0.5),
+                                                    percentile(h.buckets, h.count, 0.99)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('addr')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--json', action='store_true', help='print the same JSON as the --stats-file dump')
+    args = parser.parse_args()
+
+    try:
+        st = get_stats(args.addr, args.port, args.timeout)
+    except socket.timeout:
+        print('No answer from', args.addr, args.port, file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(to_dict(st), indent=1, sort_keys=True))
+    else:
+        print_stats(st)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())